@@ -1,38 +1,154 @@
-from openai import OpenAI   
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
+import httpx
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator
 from loguru import logger
+from response_cache import response_cache
+from model_limiter import ModelLimiter, ModelBusyError, parse_model_limits
+from context_builder import ContextBuilder
+from model_router import ModelRouter
 load_dotenv()
 
+# One connection pool shared by every completion call
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+    ),
+    timeout=httpx.Timeout(float(os.getenv("LLM_TIMEOUT", "120")), connect=10.0)
+)
+
 try:
-    client = OpenAI(
+    client = AsyncOpenAI(
         base_url="https://openrouter.ai/api/v1",
-        api_key=os.getenv("OPENROUTER_API_KEY")
+        api_key=os.getenv("OPENROUTER_API_KEY"),
+        http_client=http_client
     )
 except Exception as e:
     print(f"Error initializing OpenAI client: {e}")
     client = None
 
-def get_ai_response(prompt: str) -> str:
+OPENROUTER_HEADERS = {
+    "HTTP-Referer": "https://ara.computer", # Optional. Site URL for rankings on openrouter.ai.
+    "X-Title": "Ara AI Chat", # Optional. Site title for rankings on openrouter.ai.
+}
+
+limiter = ModelLimiter(
+    default_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+    max_queue=int(os.getenv("LLM_MAX_QUEUE", "64")),
+    overrides=parse_model_limits(os.getenv("LLM_MODEL_CONCURRENCY", ""))
+)
+
+async def close_ai_client():
+    await http_client.aclose()
+
+WHALE_MODEL = "gpt-4"
+WHALE_SYSTEM_PROMPT = "You are a whale expert. You are given a prompt and you need to respond with a response that is helpful to the user."
+
+async def get_ai_response(prompt: str) -> str:
     if client is None:
         return "Error: OpenAI client not initialized"
 
-    response = client.chat.completions.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are a whale expert. You are given a prompt and you need to respond with a response that is helpful to the user."},
-            {"role": "user", "content": prompt}
-        ]
+    cached = await response_cache.get(WHALE_MODEL, WHALE_SYSTEM_PROMPT, prompt)
+    if cached is not None:
+        return cached
+
+    async with limiter.slot(WHALE_MODEL):
+        response = await client.chat.completions.create(
+            model=WHALE_MODEL,
+            messages=[
+                {"role": "system", "content": WHALE_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        )
+    answer = response.choices[0].message.content
+    if answer:
+        await response_cache.set(WHALE_MODEL, WHALE_SYSTEM_PROMPT, prompt, answer)
+    return answer
+
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "openai/gpt-4o-mini")
+
+async def summarize_messages(previous_summary: str, messages: List[Dict[str, Any]]) -> str:
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    prompt = "Update the running summary of a chat with the new messages below. Keep names, facts, decisions and open questions. Reply with the summary only."
+    if previous_summary:
+        prompt += f"\n\nCurrent summary:\n{previous_summary}"
+    prompt += f"\n\nNew messages:\n{transcript}"
+
+    async with limiter.slot(SUMMARY_MODEL):
+        response = await client.chat.completions.create(
+            extra_headers=OPENROUTER_HEADERS,
+            model=SUMMARY_MODEL,
+            messages=[{"role": "user", "content": prompt}]
+        )
+    return response.choices[0].message.content or previous_summary
+
+context_builder = ContextBuilder(
+    summarize_messages,
+    summary_tokens=int(os.getenv("CONTEXT_SUMMARY_TOKENS", "500")),
+    backfill_tokens=int(os.getenv("CONTEXT_BACKFILL_TOKENS", "12000")),
+    # Shares the response cache's SQLite file unless given its own
+    path=os.getenv("CONTEXT_SUMMARY_PATH") or os.getenv("AI_CACHE_PATH") or None
+)
+
+def _system_prompt(bot_info: Dict[str, Any]) -> str:
+    if 'systemPrompt' in bot_info:
+        return bot_info['systemPrompt']
+    return "You are a helpful and enthusiastic chat assistant named " + bot_info['name'] + ". Respond in a friendly and concise manner. Keep your messages relatively short and engaging."
+
+def _format_chat_messages(messages: List[Dict[str, Any]], bot_info: Dict[str, Any], model: str, thread_id: str = None) -> List[Dict[str, str]]:
+    # Fill the model's token budget newest-first; older turns live in the thread summary
+    return context_builder.build(thread_id, _system_prompt(bot_info), messages, model)
+
+def _chat_model(bot_info: Dict[str, Any]) -> str:
+    model = "microsoft/wizardlm-2-8x22b"
+    if 'model' in bot_info:
+        model = bot_info['model']
+    return model
+
+async def _model_stream(model: str, formatted_messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+    async with limiter.slot(model):
+        stream = await client.chat.completions.create(
+            extra_headers=OPENROUTER_HEADERS,
+            model=model,
+            messages=formatted_messages,
+            stream=True
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+router = ModelRouter(
+    _model_stream,
+    default_fallbacks=[model for model in os.getenv("LLM_FALLBACK_MODELS", "").split(",") if model],
+    hedge=os.getenv("LLM_HEDGE", "0") == "1",
+    hedge_delay=float(os.getenv("LLM_HEDGE_DELAY", "3")),
+    max_hedge_delay=float(os.getenv("LLM_HEDGE_MAX_DELAY", "10"))
+)
+
+def _routed_stream(messages: List[Dict[str, Any]], bot_info: Dict[str, Any], thread_id: str = None) -> AsyncIterator[str]:
+    # Each candidate model gets a context built for its own token budget
+    return router.stream(
+        _chat_model(bot_info),
+        bot_info,
+        lambda model: _format_chat_messages(messages, bot_info, model, thread_id)
     )
-    return response.choices[0].message.content
 
-def get_chat_ai_response(messages: List[Dict[str, Any]], bot_info: Dict[str, Any]) -> str:
+async def get_chat_ai_response(messages: List[Dict[str, Any]], bot_info: Dict[str, Any], thread_id: str = None) -> str:
     """
     Process a list of chat messages and generate an AI response.
     
+    The bot's model is tried first, then bot_info['fallbackModels'] (or
+    LLM_FALLBACK_MODELS); bot_info['hedge'] overrides LLM_HEDGE.
+    
     Args:
         messages: A list of message objects with 'role', 'content', and other fields
+        bot_info: The thread's bot settings (name, model, systemPrompt)
+        thread_id: Enables the rolling summary of turns that no longer fit the context
         
     Returns:
         A string containing the AI's response
@@ -42,38 +158,36 @@ def get_chat_ai_response(messages: List[Dict[str, Any]], bot_info: Dict[str, Any
     
     print("bot_info", bot_info)
     
-    model = "microsoft/wizardlm-2-8x22b"
-    if 'model' in bot_info:
-        model = bot_info['model']
+    try:
+        chunks = [delta async for delta in _routed_stream(messages, bot_info, thread_id)]
+        return "".join(chunks)
+    except ModelBusyError:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting AI response: {e}")
+        return f"Sorry, I'm having trouble responding right now. Error: {str(e)}"
 
-    if 'systemPrompt' in bot_info:
-        # Format messages for OpenAI API
-        formatted_messages = [
-            {"role": "developer", "content": bot_info['systemPrompt']}
-        ]
-    else:
-        formatted_messages = [
-            {"role": "developer", "content": "You are a helpful and enthusiastic chat assistant named " + bot_info['name'] + ". Respond in a friendly and concise manner. Keep your messages relatively short and engaging."}
-        ]
+async def stream_chat_ai_response(messages: List[Dict[str, Any]], bot_info: Dict[str, Any], thread_id: str = None) -> AsyncIterator[str]:
+    """
+    Same as get_chat_ai_response, but yields content deltas as they arrive.
     
-    # Add conversation history (limit to last 10 messages to keep context manageable)
-    for msg in messages[-10:]:
-        if "role" in msg and "content" in msg:
-            formatted_messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
+    Args:
+        messages: A list of message objects with 'role', 'content', and other fields
+        bot_info: The thread's bot settings (name, model, systemPrompt)
+        thread_id: Enables the rolling summary of turns that no longer fit the context
+        
+    Yields:
+        Chunks of the AI's response text
+    """
+    if client is None:
+        yield "Error: OpenAI client not initialized"
+        return
     
     try:
-        response = client.chat.completions.create(
-            extra_headers={
-                "HTTP-Referer": "https://ara.computer", # Optional. Site URL for rankings on openrouter.ai.
-                "X-Title": "Ara AI Chat", # Optional. Site title for rankings on openrouter.ai.
-            },
-            model=model,
-            messages=formatted_messages
-        )
-        return response.choices[0].message.content
+        async for delta in _routed_stream(messages, bot_info, thread_id):
+            yield delta
+    except ModelBusyError:
+        raise
     except Exception as e:
-        logger.error(f"Error getting AI response: {e}")
-        return f"Sorry, I'm having trouble responding right now. Error: {str(e)}"
+        logger.error(f"Error streaming AI response: {e}")
+        yield f"Sorry, I'm having trouble responding right now. Error: {str(e)}"
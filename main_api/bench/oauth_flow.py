@@ -0,0 +1,219 @@
+"""
+End-to-end load test of the OAuth flow, run in-process against a throwaway SQLite file.
+
+Each virtual user has its own cookie jar and repeats the whole flow:
+register_client -> register_user -> login -> consent -> token (authorization_code)
+-> token (refresh_token) -> userinfo. Per-step latency percentiles and throughput
+are printed and written as JSON; pass --compare with an earlier result to see the
+change per step.
+
+    cd main_api && python bench/oauth_flow.py --users 20 --iterations 5 --output flow.json
+    cd main_api && python bench/oauth_flow.py --compare flow.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from urllib.parse import parse_qs, urlparse
+
+MAIN_API = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REDIRECT_URI = "http://bench/callback"
+STEPS = ["register_client", "register_user", "login", "consent", "token_code", "token_refresh", "userinfo"]
+
+
+class StepFailed(Exception):
+    pass
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    async def call(self, step: str, request, expect: int):
+        started = time.perf_counter()
+        try:
+            response = await request
+        except Exception as e:
+            self.errors[step][type(e).__name__] += 1
+            raise StepFailed(step) from e
+        self.latencies[step].append((time.perf_counter() - started) * 1000)
+        if response.status_code != expect:
+            self.errors[step][str(response.status_code)] += 1
+            raise StepFailed(step)
+        return response
+
+
+async def flow(client, recorder: Recorder, password: str):
+    tag = uuid.uuid4().hex[:12]
+    response = await recorder.call("register_client", client.post(
+        "/oauth2/register_client", params={"name": f"bench-{tag}", "redirect_uri": REDIRECT_URI}), 200)
+    credentials = response.json()
+    params = {"client_id": credentials["client_id"], "redirect_uri": REDIRECT_URI, "scope": "profile", "state": tag}
+
+    await recorder.call("register_user", client.post(
+        "/oauth2/register_user", data={"username": f"user-{tag}", "password": password}), 200)
+
+    # A login carrying client details answers with the consent page
+    await recorder.call("login", client.post(
+        "/oauth2/login", data={"username": f"user-{tag}", "password": password, **params}), 200)
+
+    response = await recorder.call("consent", client.post(
+        "/oauth2/consent", data={"consent": "yes", **params}), 302)
+    code = parse_qs(urlparse(response.headers["location"]).query)["code"][0]
+
+    grant = {"redirect_uri": REDIRECT_URI, "client_id": credentials["client_id"],
+             "client_secret": credentials["client_secret"]}
+    response = await recorder.call("token_code", client.post(
+        "/oauth2/token", data={"grant_type": "authorization_code", "code": code, **grant}), 200)
+    tokens = response.json()
+
+    response = await recorder.call("token_refresh", client.post(
+        "/oauth2/token", data={"grant_type": "refresh_token", "refresh_token": tokens["refresh_token"], **grant}), 200)
+    tokens = response.json()
+
+    await recorder.call("userinfo", client.get(
+        "/oauth2/userinfo", headers={"Authorization": f"Bearer {tokens['access_token']}"}), 200)
+
+
+async def run(app, users: int, iterations: int, password: str):
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    recorder = Recorder()
+    completed = 0
+
+    async def virtual_user():
+        nonlocal completed
+        # Own client per user: the login session lives in its cookie jar
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            for _ in range(iterations):
+                try:
+                    await flow(client, recorder, password)
+                    completed += 1
+                except StepFailed:
+                    pass
+
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user() for _ in range(users)))
+    return recorder, completed, time.perf_counter() - started
+
+
+def summarize(recorder: Recorder, completed: int, elapsed: float, args) -> dict:
+    from metrics import percentile
+    from oauth.passwords import password_hasher
+
+    steps = {}
+    for step in STEPS:
+        samples = recorder.latencies[step]
+        steps[step] = {
+            "count": len(samples),
+            "errors": dict(recorder.errors[step]),
+            # Requests per second of time spent in this step, i.e. what one stream of calls sustains
+            "service_rps": len(samples) * 1000 / sum(samples) if samples else 0.0,
+            "latency_ms": {
+                "mean": sum(samples) / len(samples) if samples else None,
+                "p50": percentile(samples, 50),
+                "p95": percentile(samples, 95),
+                "p99": percentile(samples, 99),
+                "max": max(samples) if samples else None,
+            },
+        }
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "at": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "users": args.users,
+            "iterations": args.iterations,
+            "password_workers": password_hasher.stats()["workers"],
+        },
+        "elapsed_s": elapsed,
+        "flows_completed": completed,
+        "flows_per_s": completed / elapsed if elapsed else 0.0,
+        "requests_per_s": sum(len(samples) for samples in recorder.latencies.values()) / elapsed if elapsed else 0.0,
+        "steps": steps,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=MAIN_API, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(result: dict, baseline: dict = None):
+    def fmt(value):
+        return f"{value:9.1f}" if value is not None else "        -"
+
+    print(f"{result['flows_completed']} flows in {result['elapsed_s']:.1f}s "
+          f"({result['flows_per_s']:.1f} flows/s, {result['requests_per_s']:.1f} req/s)")
+    print(f"{'step':<15}{'count':>7}{'errors':>8}{'svc/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          + (f"{'p95 vs base':>13}" if baseline else ""))
+    for step, stats in result["steps"].items():
+        latency = stats["latency_ms"]
+        line = (f"{step:<15}{stats['count']:>7}{sum(stats['errors'].values()):>8}{stats['service_rps']:>9.1f}"
+                f"{fmt(latency['p50'])}{fmt(latency['p95'])}{fmt(latency['p99'])}")
+        base = baseline["steps"].get(step, {}).get("latency_ms", {}).get("p95") if baseline else None
+        if base and latency["p95"] is not None:
+            line += f"{(latency['p95'] - base) / base * 100:>+12.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=3, help="flows per virtual user")
+    parser.add_argument("--password", default="bench-password")
+    parser.add_argument("--output", help="write the JSON result here")
+    parser.add_argument("--compare", help="earlier JSON result to compare p95 latency against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # Fresh database every run; oauth.log also lands in the temp directory
+    sys.path.insert(0, MAIN_API)
+    workdir = tempfile.mkdtemp(prefix="oauth-flow-bench-")
+    os.chdir(workdir)
+    os.environ["OAUTH_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    # Every virtual user shares one client address; measure the flow, not the per-IP limit
+    os.environ.setdefault("OAUTH_RATE_LIMIT", "0")
+
+    from fastapi import FastAPI
+    from starlette.middleware.sessions import SessionMiddleware
+    from oauth import server
+    from oauth.passwords import password_hasher
+
+    app = FastAPI()
+    app.add_middleware(SessionMiddleware, secret_key=uuid.uuid4().hex, session_cookie="oauth_session")
+    app.include_router(server.router)
+
+    try:
+        recorder, completed, elapsed = asyncio.run(run(app, args.users, args.iterations, args.password))
+    finally:
+        password_hasher.shutdown()
+
+    result = summarize(recorder, completed, elapsed, args)
+    report(result, baseline)
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Check that cancelling a hedged ModelRouter stream leaves nothing running.
+
+Fake models hold a ModelLimiter slot while they stream. The consumer is cancelled
+during the hedge wait, during the race between primary and hedge, and while the
+winner is streaming; a racer whose messages cannot be formatted is tried too.
+After each case no task may be pending and every slot must be released. Exits 1
+otherwise.
+
+    cd main_api && python bench/router_cancel.py
+"""
+import asyncio
+import os
+import sys
+
+MAIN_API = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def case(name: str, cancel_after: float, first_token_s: float, format_fails: bool = False) -> bool:
+    from model_limiter import ModelLimiter
+    from model_router import ModelRouter
+
+    limiter = ModelLimiter(default_concurrency=4, max_queue=4)
+
+    async def open_stream(model, messages):
+        async with limiter.slot(model):
+            await asyncio.sleep(first_token_s)
+            for i in range(100):
+                yield f"{model}-{i} "
+                await asyncio.sleep(0.01)
+
+    def format_for(model):
+        if format_fails and model == "hedge":
+            raise ValueError("cannot format")
+        return []
+
+    router = ModelRouter(open_stream, default_fallbacks=["hedge"], hedge=True, hedge_delay=0.05)
+    before = asyncio.all_tasks()
+
+    async def consume():
+        async for _ in router.stream("primary", {}, format_for):
+            pass
+
+    consumer = asyncio.create_task(consume())
+    await asyncio.sleep(cancel_after)
+    consumer.cancel()
+    await asyncio.gather(consumer, return_exceptions=True)
+    await asyncio.sleep(0)
+
+    leaked = [task for task in asyncio.all_tasks() - before if not task.done()]
+    in_flight = sum(state["in_flight"] for state in limiter.stats().values())
+    ok = not leaked and in_flight == 0
+    print(f"{name:<28}{'ok' if ok else 'FAILED'}  pending tasks={len(leaked)} held slots={in_flight}")
+    return ok
+
+
+async def run() -> bool:
+    results = [
+        await case("during hedge wait", cancel_after=0.02, first_token_s=1.0),
+        await case("during race", cancel_after=0.2, first_token_s=1.0),
+        await case("while streaming winner", cancel_after=0.2, first_token_s=0.01),
+        await case("hedge format fails", cancel_after=0.2, first_token_s=1.0, format_fails=True),
+    ]
+    return all(results)
+
+
+def main():
+    sys.path.insert(0, MAIN_API)
+    sys.exit(0 if asyncio.run(run()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Requests per second for GET /oauth2/userinfo with and without the verification caches.
+
+Runs the OAuth router in-process against a throwaway SQLite file:
+
+    cd main_api && python bench/userinfo.py --requests 5000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+MAIN_API = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def run(app, token: str, requests: int, concurrency: int) -> float:
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    headers = {"Authorization": f"Bearer {token}"}
+    remaining = iter(range(requests))
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker():
+            for _ in remaining:
+                response = await client.get("/oauth2/userinfo", headers=headers)
+                assert response.status_code == 200, response.text
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return requests / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    # The OAuth module opens ara.db and oauth.log relative to the working directory
+    sys.path.insert(0, MAIN_API)
+    os.chdir(tempfile.mkdtemp(prefix="userinfo-bench-"))
+
+    from fastapi import FastAPI
+    from oauth import database, server
+
+    app = FastAPI()
+    app.include_router(server.router)
+
+    session = database.Session()
+    user = server.UserDB(username="bench", password="x", display_name="bench")
+    session.add(user)
+    session.commit()
+    token = server.create_access_token(user.id, "bench-client", timedelta(hours=1))
+    session.close()
+
+    results = {}
+    for label, enabled in (("uncached", False), ("cached", True)):
+        server.USERINFO_CACHE_ENABLED = enabled
+        server.verified_tokens.clear()
+        server.invalidate_user()
+        results[label] = asyncio.run(run(app, token, args.requests, args.concurrency))
+        print(f"{label:>9}: {results[label]:8.0f} req/s")
+
+    print(f"  speedup: {results['cached'] / results['uncached']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from ttl_cache import TTLCache
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # tiktoken is optional; fall back to the usual ~4 characters per token estimate
+    _encoding = None
+
+# Per-message framing overhead (role, separators) in chat formats
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Prompt budgets, leaving the rest of each model's window for the reply
+MODEL_TOKEN_BUDGETS = {
+    "gpt-4": 6000,
+    "microsoft/wizardlm-2-8x22b": 12000,
+}
+DEFAULT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        # User text may contain strings like <|endoftext|>; count them as plain text instead of raising
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    if _encoding is not None:
+        tokens = _encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else _encoding.decode(tokens[-max_tokens:])
+    return text[-max_tokens * 4:]
+
+
+def token_budget(model: str) -> int:
+    return MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+
+
+class ContextBuilder:
+    """
+    Builds the prompt for a thread within a per-model token budget.
+
+    Messages are taken newest to oldest until the budget is spent. Everything older
+    is folded into a rolling per-thread summary that is extended in the background
+    as messages leave the window, so each turn only summarizes the new overflow.
+
+    With `path` set, summaries are also written to that SQLite file (off the event
+    loop) and loaded back at startup, so a restart or --reload does not summarize
+    every long thread again. A thread with no summary only has its newest
+    `backfill_tokens` of overflow summarized; anything older is left out.
+
+    Args:
+        summarize: Coroutine (previous_summary, messages) -> new summary
+        summary_tokens: Budget reserved for the summary in the prompt
+        min_batch: Unsummarized overflow messages needed before the summary is extended
+        chunk_tokens: Upper bound on the transcript sent to one summarize call
+        backfill_tokens: Overflow summarized when a thread has no summary yet
+        path: Optional SQLite file that keeps summaries across restarts
+    """
+
+    def __init__(self, summarize: Callable[[str, List[Dict[str, Any]]], Awaitable[str]],
+                 summary_tokens: int = 500, min_batch: int = 4, chunk_tokens: int = 3000,
+                 backfill_tokens: int = 12000, max_threads: int = 10000, ttl: float = 7 * 24 * 3600,
+                 path: Optional[str] = None):
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.min_batch = min_batch
+        self.chunk_tokens = chunk_tokens
+        self.backfill_tokens = backfill_tokens
+        self.ttl = ttl
+        # thread_id -> {"upto": messages covered, "anchor": first message, "text": summary}
+        self._summaries = TTLCache(maxsize=max_threads, ttl=ttl)
+        self._updating: Dict[str, asyncio.Task] = {}
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._counters = {"summarize_calls": 0, "backfill_skipped": 0}
+        if path:
+            self._open(path)
+
+    def _open(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS thread_summaries (
+                thread_id TEXT PRIMARY KEY,
+                upto INTEGER NOT NULL,
+                anchor TEXT,
+                text TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_thread_summaries_updated_at ON thread_summaries (updated_at)")
+        self._db.execute("DELETE FROM thread_summaries WHERE updated_at <= ?", (time.time() - self.ttl,))
+        self._db.commit()
+
+        # Warm memory with the most recently updated threads
+        rows = self._db.execute(
+            "SELECT thread_id, upto, anchor, text, updated_at FROM thread_summaries "
+            "ORDER BY updated_at DESC LIMIT ?",
+            (self._summaries.maxsize,)
+        ).fetchall()
+        for thread_id, upto, anchor, text, updated_at in reversed(rows):
+            self._summaries.set(thread_id, {"upto": upto, "anchor": anchor, "text": text},
+                                ttl=self.ttl - (time.time() - updated_at))
+        logger.info(f"Context builder loaded {len(rows)} thread summaries from {path}")
+
+    def _store(self, thread_id: str, summary: Dict[str, Any]):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO thread_summaries (thread_id, upto, anchor, text, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (thread_id, summary["upto"], summary["anchor"], summary["text"], time.time())
+            )
+            self._db.commit()
+
+    def _summary_for(self, thread_id: Optional[str], messages: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if thread_id is None:
+            return None
+        summary = self._summaries.get(thread_id)
+        if summary is None:
+            return None
+        # Discard the summary if the thread was edited underneath it
+        if summary["upto"] > len(messages) or (messages and messages[0].get("content") != summary["anchor"]):
+            self._summaries.pop(thread_id)
+            return None
+        return summary
+
+    def build(self, thread_id: Optional[str], system_prompt: str, messages: List[Dict[str, Any]],
+              model: str) -> List[Dict[str, str]]:
+        history = [msg for msg in messages if "role" in msg and "content" in msg]
+        summary = self._summary_for(thread_id, history)
+
+        budget = token_budget(model) - count_tokens(system_prompt) - MESSAGE_OVERHEAD_TOKENS
+        if thread_id is not None:
+            budget -= self.summary_tokens
+
+        window: List[Dict[str, str]] = []
+        start = len(history)
+        for msg in reversed(history):
+            cost = message_tokens(msg)
+            if cost > budget:
+                if not window:
+                    # A single oversized latest message: keep its tail rather than nothing
+                    content = truncate_to_tokens(msg["content"] or "", budget - MESSAGE_OVERHEAD_TOKENS)
+                    window.append({"role": msg["role"], "content": content})
+                    start -= 1
+                break
+            window.append({"role": msg["role"], "content": msg["content"]})
+            budget -= cost
+            start -= 1
+        window.reverse()
+
+        formatted = [{"role": "developer", "content": system_prompt}]
+        if summary is not None and summary["text"]:
+            summary_message = "Summary of the earlier conversation: " + summary["text"]
+            formatted.append({"role": "developer", "content": summary_message})
+            budget -= count_tokens(summary_message) + MESSAGE_OVERHEAD_TOKENS
+
+        if thread_id is not None:
+            # Turns past the summary but outside the window stay in the prompt as raw turns,
+            # in whatever budget is left, until they are folded into the summary
+            covered = summary["upto"] if summary else 0
+            budget += self.summary_tokens
+            pending: List[Dict[str, str]] = []
+            for msg in reversed(history[covered:start]):
+                cost = message_tokens(msg)
+                if cost > budget:
+                    break
+                pending.append({"role": msg["role"], "content": msg["content"]})
+                budget -= cost
+            pending.reverse()
+            formatted.extend(pending)
+
+            # Fold them in once there are enough, or right away if some did not fit
+            if start - covered >= self.min_batch or len(pending) < start - covered:
+                self._schedule_update(thread_id, history, start)
+
+        formatted.extend(window)
+
+        return formatted
+
+    def _schedule_update(self, thread_id: str, history: List[Dict[str, Any]], upto: int):
+        if thread_id in self._updating:
+            return
+        task = asyncio.create_task(self._update_summary(thread_id, history, upto))
+        self._updating[thread_id] = task
+        task.add_done_callback(lambda _: self._updating.pop(thread_id, None))
+
+    async def _update_summary(self, thread_id: str, history: List[Dict[str, Any]], upto: int):
+        summary = self._summary_for(thread_id, history)
+        if summary is None:
+            # Cold start: summarize only the newest overflow instead of the whole history
+            begin, used = upto, 0
+            while begin > 0 and used + message_tokens(history[begin - 1]) <= self.backfill_tokens:
+                begin -= 1
+                used += message_tokens(history[begin])
+            if begin:
+                self._counters["backfill_skipped"] += begin
+                logger.info(f"[Thread ID: {thread_id}] Summarizing the newest {upto - begin} of {upto} overflow messages")
+            summary = {"upto": begin, "anchor": history[0].get("content") if history else None, "text": ""}
+        try:
+            while summary["upto"] < upto:
+                # Fold the next chunk of overflow into the running summary
+                chunk, used = [], 0
+                for msg in history[summary["upto"]:upto]:
+                    cost = message_tokens(msg)
+                    if chunk and used + cost > self.chunk_tokens:
+                        break
+                    chunk.append({"role": msg["role"], "content": truncate_to_tokens(msg["content"] or "", self.chunk_tokens)})
+                    used += cost
+
+                text = await self.summarize(summary["text"], chunk)
+                self._counters["summarize_calls"] += 1
+                summary = {
+                    "upto": summary["upto"] + len(chunk),
+                    "anchor": summary["anchor"],
+                    "text": truncate_to_tokens(text, self.summary_tokens)
+                }
+                self._summaries.set(thread_id, summary)
+                if self._db is not None:
+                    await asyncio.to_thread(self._store, thread_id, summary)
+        except Exception as e:
+            logger.error(f"[Thread ID: {thread_id}] Error updating rolling summary: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "summaries": len(self._summaries),
+            "updating": len(self._updating),
+            **self._counters,
+            "persistent": self._db is not None,
+            "tokenizer": "tiktoken" if _encoding is not None else "estimate",
+        }
@@ -1,4 +1,10 @@
+import asyncio
+import hashlib
+import json
 import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from loguru import logger
 from supabase import create_client, Client
 
 url: str = os.environ.get("SUPABASE_URL")
@@ -9,3 +15,60 @@ def get_whales():
     response = supabase.table("whales").select("*").execute()
     return response.data
 
+class WhalesSnapshot:
+    """
+    In-memory snapshot of the whales table with stale-while-revalidate refresh.
+
+    Fresh for `ttl` seconds. After that the stale snapshot is still served for up to
+    `max_stale` seconds while one background refresh runs; only a cold or very old
+    cache makes a request wait on Supabase.
+    """
+
+    def __init__(self, ttl: float = 30, max_stale: float = 600):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.data: Optional[List[Dict[str, Any]]] = None
+        self.etag: Optional[str] = None
+        self.loaded_at = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+        self._stats = {"fresh": 0, "stale": 0, "waited": 0, "refreshes": 0, "refresh_errors": 0}
+
+    async def _refresh(self):
+        try:
+            data = await asyncio.to_thread(get_whales)
+        except Exception as e:
+            self._stats["refresh_errors"] += 1
+            logger.error(f"Error refreshing whales snapshot: {e}")
+            raise
+        body = json.dumps(data, sort_keys=True, default=str).encode()
+        self.data = data
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.loaded_at = time.monotonic()
+        self._stats["refreshes"] += 1
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._refresh())
+            # Background failures are already logged; keep serving the old snapshot
+            self._refreshing.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self._refreshing
+
+    async def get(self) -> Tuple[List[Dict[str, Any]], str]:
+        age = time.monotonic() - self.loaded_at
+        if self.data is not None and age < self.ttl:
+            self._stats["fresh"] += 1
+        elif self.data is not None and age < self.ttl + self.max_stale:
+            self._stats["stale"] += 1
+            self._start_refresh()
+        else:
+            self._stats["waited"] += 1
+            await asyncio.shield(self._start_refresh())
+        return self.data, self.etag
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "rows": len(self.data) if self.data is not None else None}
+
+whales_snapshot = WhalesSnapshot(
+    ttl=float(os.environ.get("WHALES_CACHE_TTL", "30")),
+    max_stale=float(os.environ.get("WHALES_CACHE_MAX_STALE", "600"))
+)
@@ -0,0 +1,143 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from ttl_cache import TTLCache
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue is at its maximum depth."""
+
+
+@dataclass
+class Job:
+    thread_id: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    status: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    worker: Optional[int] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "thread_id": self.thread_id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    Bounded in-process queue drained by a fixed pool of asyncio workers.
+
+    Args:
+        handler: Coroutine run for each job; its return value becomes job.result
+        workers: Number of concurrent workers
+        max_depth: Queued (not yet started) jobs allowed before submit() refuses
+        keep: Finished jobs kept for status lookups
+        ttl: Seconds a finished job stays visible
+    """
+
+    def __init__(self, handler: Callable[[Job], Awaitable[Dict[str, Any]]], workers: int = 4,
+                 max_depth: int = 100, keep: int = 10000, ttl: float = 3600):
+        self.handler = handler
+        self.worker_count = workers
+        self.max_depth = max_depth
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: "OrderedDict[str, Job]" = OrderedDict()
+        self._jobs = TTLCache(maxsize=keep, ttl=ttl)
+        self._workers: List[asyncio.Task] = []
+        self._worker_stats: List[Dict[str, Any]] = []
+        self._started_at: Optional[float] = None
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_depth)
+        self._started_at = time.monotonic()
+        self._worker_stats = [
+            {"id": i, "busy": False, "processed": 0, "failed": 0, "busy_seconds": 0.0}
+            for i in range(self.worker_count)
+        ]
+        self._workers = [asyncio.create_task(self._work(i)) for i in range(self.worker_count)]
+        logger.info(f"Started {self.worker_count} job workers")
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, thread_id: str, **payload) -> Job:
+        if self._queue is None:
+            raise RuntimeError("Job queue is not running")
+        job = Job(thread_id=thread_id, payload=payload)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Job queue is full ({self.max_depth} jobs waiting)")
+        self._pending[job.id] = job
+        self._jobs.set(job.id, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def _work(self, worker_id: int):
+        stats = self._worker_stats[worker_id]
+        while True:
+            job = await self._queue.get()
+            self._pending.pop(job.id, None)
+            job.status = "running"
+            job.worker = worker_id
+            job.started_at = time.time()
+            stats["busy"] = True
+            try:
+                job.result = await self.handler(job)
+                job.status = "succeeded"
+                stats["processed"] += 1
+            except asyncio.CancelledError:
+                job.status = "failed"
+                job.error = "Worker stopped"
+                raise
+            except Exception as e:
+                logger.error(f"[Job {job.id}] Failed: {e}")
+                job.status = "failed"
+                job.error = str(e)
+                stats["failed"] += 1
+            finally:
+                job.finished_at = time.time()
+                stats["busy"] = False
+                stats["busy_seconds"] += job.finished_at - job.started_at
+                self._jobs.set(job.id, job)
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        oldest = next(iter(self._pending.values()), None)
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            "depth": len(self._pending),
+            "max_depth": self.max_depth,
+            "oldest_age_seconds": time.time() - oldest.created_at if oldest else 0.0,
+            "tracked_jobs": len(self._jobs),
+            "workers": [
+                {
+                    **worker,
+                    "jobs_per_minute": 60 * (worker["processed"] + worker["failed"]) / uptime if uptime else 0.0,
+                    "utilization": worker["busy_seconds"] / uptime if uptime else 0.0,
+                }
+                for worker in self._worker_stats
+            ],
+        }
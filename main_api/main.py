@@ -1,26 +1,51 @@
-from fastapi import FastAPI, Request, Path, Body, Form
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
+from fastapi import FastAPI, Request, Path, Body, Form, Header, HTTPException, BackgroundTasks
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.middleware import Middleware
 from starlette.middleware.base import BaseHTTPMiddleware
-import httpx
+from contextlib import asynccontextmanager
 import subprocess
 import os
-from ai import get_ai_response, get_chat_ai_response
-from db import get_whales
-from typing import List, Dict, Any
+from ai import get_ai_response, get_chat_ai_response, stream_chat_ai_response, ModelBusyError, limiter, close_ai_client, context_builder, router
+from db import whales_snapshot
+from typing import List, Dict, Any, Awaitable, Callable
 from pydantic import BaseModel
 from loguru import logger
-from oauth.server import router as oauth_router
+from oauth.server import router as oauth_router, sweeper as oauth_sweeper, static_files as oauth_static_files
+from oauth.passwords import password_hasher
+from oauth.database import async_engine as oauth_async_engine
+from messaging_client import messaging
+from response_cache import response_cache
+from web_assets import CompressionMiddleware, HashedStaticFiles, compressor, create_templates
+from single_flight import SingleFlight
+from jobs import JobQueue, QueueFullError, Job
 import secrets
+import json
+import hashlib
+import asyncio
 
 class UserMessage(BaseModel):
     message: str = None
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await messaging.start()
+    await reply_jobs.start()
+    if os.getenv("OAUTH_SWEEPER", "1") == "1":
+        oauth_sweeper.start()
+    yield
+    # Let streamed replies whose clients left finish persisting
+    await asyncio.gather(*reply_streams, return_exceptions=True)
+    await oauth_sweeper.stop()
+    await reply_jobs.stop()
+    await messaging.close()
+    await close_ai_client()
+    password_hasher.shutdown()
+    await oauth_async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware to allow requests from the frontend
 app.add_middleware(
@@ -41,10 +66,23 @@ app.add_middleware(
     https_only=False  # Allow cookies in development
 )
 
+# Compress pages, assets and JSON; outermost so it sees the final body
+app.add_middleware(CompressionMiddleware, compressor=compressor)
+
 # Include OAuth router
 app.include_router(oauth_router)
 
-templates = Jinja2Templates(directory="templates")
+static_files = HashedStaticFiles("static", "/static")
+app.mount("/static", static_files, name="static")
+app.mount("/oauth2/static", oauth_static_files, name="oauth_static")
+
+templates = create_templates("templates", static_files)
+
+# Coalesces duplicate thread replies and remembers them for retries
+thread_replies = SingleFlight(
+    maxsize=int(os.getenv("REPLY_DEDUPE_SIZE", "10000")),
+    ttl=float(os.getenv("REPLY_DEDUPE_TTL", "300"))
+)
 
 logger.info("App starting up!")
 
@@ -52,99 +90,284 @@ logger.info("App starting up!")
 async def home(request: Request):
     return templates.TemplateResponse("shell.html", {"request": request})
 
+async def persist_message(message: Dict[str, str]) -> bool:
+    response = await messaging.post_with_retry("/messages", json=message)
+    if response is None or response.status_code >= 400:
+        logger.error(f"Failed to persist {message['role']} message to messaging service")
+        return False
+    return True
+
+async def persist_execute_messages(user_write: asyncio.Task, ai_response: str = None):
+    # Keep the user message ahead of the answer in the log
+    await user_write
+    if ai_response is not None:
+        await persist_message({"role": "assistant", "content": ai_response})
+
 @app.post("/execute")
-async def execute_command(command: dict):
+async def execute_command(command: dict, background_tasks: BackgroundTasks):
+    user_write = None
+    ai_response = None
     try:
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                "http://localhost:3000/messages",
-                json={"role": "user", "content": command["command"]}
-            )
+        # Persist the user message while the model is already working on the answer
+        user_write = asyncio.create_task(persist_message({"role": "user", "content": command["command"]}))
 
         # Get AI response
-        ai_response = get_ai_response(command["command"])
-        
-        # Post user message to localhost:3000/messages
-        async with httpx.AsyncClient() as client:
-            # Post AI response to localhost:3000/messages
-            await client.post(
-                "http://localhost:3000/messages",
-                json={"role": "assistant", "content": ai_response}
-            )
+        ai_response = await get_ai_response(command["command"])
         
         return {"output": ai_response}
+    except ModelBusyError as e:
+        return model_busy_response(e)
     except Exception as e:
         return {"error": str(e)}
+    finally:
+        if user_write is not None:
+            # Post AI response to localhost:3000/messages after the response is sent
+            background_tasks.add_task(persist_execute_messages, user_write, ai_response)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    # Weak comparison: CompressionMiddleware sends W/ tags for encoded bodies
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
 
 @app.get("/whales")
-async def whales_endpoint():
-    whales = get_whales()
-    print(whales)
-    return {"whales": whales}
+async def whales_endpoint(request: Request):
+    whales, etag = await whales_snapshot.get()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"whales": whales}, headers=headers)
 
 @app.get("/ping-ts")
 async def ping_ts():
-    async with httpx.AsyncClient() as client:
-        r = await client.get("http://localhost:3000/ping")
-        return {"response_from_ts": r.json()}
+    r = await messaging.get("/ping", timeout=2.0)
+    return {"response_from_ts": r.json()}
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "main_api"}
 
+@app.get("/stats")
+async def stats():
+    return {
+        "llm": limiter.stats(),
+        "messaging": messaging.stats(),
+        "response_cache": response_cache.stats(),
+        "context": context_builder.stats(),
+        "thread_replies": thread_replies.stats(),
+        "jobs": reply_jobs.stats(),
+        "routing": router.stats(),
+        "whales": whales_snapshot.stats(),
+        "compression": compressor.stats()
+    }
+
+def model_busy_response(e: ModelBusyError):
+    return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": "1"})
+
 async def get_thread_info(thread_id: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"http://localhost:3000/threads/{thread_id}")
-        result = response.json()
+    response = await messaging.get(f"/threads/{thread_id}")
+    result = response.json()
 
-        botInfo = None
-        if 'data' in result:
-            botInfo = result['data'].get('botInfo')
+    botInfo = None
+    if 'data' in result:
+        botInfo = result['data'].get('botInfo')
 
-        messages = result.get("messages")
+    messages = result.get("messages")
 
-        return messages, botInfo
+    return messages, botInfo
 
 async def post_to_instantdb(thread_id: str, message: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"http://localhost:3000/threads/{thread_id}",
-            json={"role": "assistant", "content": message}
-        )
-        if response.status_code != 201:
-            return {"error": f"Failed to add AI response to thread: {response.text}"}
-        
-        result = response.json()
-        return result
+    response = await messaging.post(
+        f"/threads/{thread_id}",
+        json={"role": "assistant", "content": message}
+    )
+    if response.status_code != 201:
+        return {"error": f"Failed to add AI response to thread: {response.text}"}
+    
+    result = response.json()
+    return result
 
 # hi there this is to hot reload
 
+def wants_event_stream(request: Request) -> bool:
+    if request.query_params.get("stream") in ("1", "true"):
+        return True
+    return "text/event-stream" in request.headers.get("accept", "")
+
+def sse_event(data: Dict[str, Any], event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def message_fingerprint(message: Dict[str, Any]) -> str:
+    if message.get("id"):
+        return str(message["id"])
+    return hashlib.sha256(str(message.get("content")).encode()).hexdigest()
+
+class ReplyError(Exception):
+    """The reply pipeline failed after generation; nothing is stored for retries."""
+
+async def store_thread_reply(thread_id: str, ai_response: str) -> Dict[str, Any]:
+    # 3. Add AI response to the thread
+    result = await post_to_instantdb(thread_id, ai_response)
+    if "error" in result:
+        raise ReplyError(result["error"])
+
+    reply = {
+        "message": "AI response added to thread successfully",
+        "response": ai_response,
+        "id": result.get("id")
+    }
+    # A retry after we posted sees our reply as the latest message; answer it from the store too
+    thread_replies.remember((thread_id, message_fingerprint({"id": result.get("id"), "content": ai_response})), reply)
+    thread_replies.remember((thread_id, message_fingerprint({"content": ai_response})), reply)
+    return reply
+
+async def generate_thread_reply(thread_id: str, thread_messages: List[Dict[str, Any]], bot_info: Dict[str, Any]) -> Dict[str, Any]:
+    # 2. Process messages and generate AI response
+    ai_response = await get_chat_ai_response(thread_messages, bot_info, thread_id)
+    logger.info(f"[Thread ID: {thread_id}] AI: {ai_response}")
+    return await store_thread_reply(thread_id, ai_response)
+
+async def produce_thread_reply(thread_id: str, thread_messages: List[Dict[str, Any]], bot_info: Dict[str, Any],
+                               deltas: asyncio.Queue) -> Dict[str, Any]:
+    """Generate and persist the reply, queueing each delta; runs to the end even if the client leaves."""
+    chunks = []
+    try:
+        async for delta in stream_chat_ai_response(thread_messages, bot_info, thread_id):
+            chunks.append(delta)
+            deltas.put_nowait(delta)
+
+        ai_response = "".join(chunks)
+        logger.info(f"[Thread ID: {thread_id}] AI (streamed): {ai_response}")
+        return await store_thread_reply(thread_id, ai_response)
+    except asyncio.CancelledError:
+        logger.warning(f"[Thread ID: {thread_id}] Streamed reply cancelled after {len(chunks)} deltas; nothing persisted")
+        raise
+    except Exception as e:
+        logger.error(f"[Thread ID: {thread_id}] Streaming error: {e}")
+        raise
+
+async def reply_once(thread_id: str, thread_messages: List[Dict[str, Any]], generate: Callable[[], Awaitable[Dict[str, Any]]],
+                     idempotency_key: str = None) -> Dict[str, Any]:
+    """Run `generate` at most once per latest message and remember the reply under the Idempotency-Key."""
+    # Concurrent requests for the same latest message share one generation
+    latest = message_fingerprint(thread_messages[-1]) if thread_messages else None
+    reply = await thread_replies.do((thread_id, latest), generate)
+    if idempotency_key:
+        thread_replies.remember((thread_id, "idempotency", idempotency_key), reply)
+    return reply
+
+# Streamed replies still being generated or persisted; kept referenced until they finish
+reply_streams = set()
+
+async def stream_thread_reply(thread_id: str, thread_messages: List[Dict[str, Any]], bot_info: Dict[str, Any],
+                              idempotency_key: str = None):
+    """Yield the reply as Server-Sent Events while a separate task generates and persists it."""
+    # Unbounded so the producer never waits on a slow or departed client
+    deltas = asyncio.Queue()
+    task = asyncio.create_task(reply_once(
+        thread_id, thread_messages, lambda: produce_thread_reply(thread_id, thread_messages, bot_info, deltas),
+        idempotency_key
+    ))
+    reply_streams.add(task)
+    task.add_done_callback(reply_streams.discard)
+    # A request coalesced onto another's generation gets no deltas, only the final reply
+    task.add_done_callback(lambda _: deltas.put_nowait(None))
+    try:
+        while (delta := await deltas.get()) is not None:
+            yield sse_event({"delta": delta})
+        try:
+            reply = task.result()
+        except Exception as e:
+            yield sse_event({"error": str(e)}, event="error")
+            return
+        yield sse_event(reply, event="done")
+    except (asyncio.CancelledError, GeneratorExit):
+        # Only the response is cancelled; the task still finishes and persists the reply
+        logger.info(f"[Thread ID: {thread_id}] Client left the stream; reply continues in the background")
+        raise
+
+async def replay_thread_reply(reply: Dict[str, Any]):
+    yield sse_event(reply, event="done")
+
+async def reply_job(job: Job) -> Dict[str, Any]:
+    thread_messages, bot_info = await get_thread_info(job.thread_id)
+    return await reply_once(
+        job.thread_id, thread_messages,
+        lambda: generate_thread_reply(job.thread_id, thread_messages, bot_info),
+        job.payload.get("idempotency_key")
+    )
+
+reply_jobs = JobQueue(
+    reply_job,
+    workers=int(os.getenv("REPLY_WORKERS", "8")),
+    max_depth=int(os.getenv("REPLY_QUEUE_DEPTH", "200"))
+)
+
+def wants_async_job(request: Request) -> bool:
+    if request.query_params.get("mode") == "async":
+        return True
+    return "respond-async" in request.headers.get("prefer", "")
+
 @app.post("/threads/{thread_id}")
 async def process_thread_message(
+    request: Request,
     thread_id: str = Path(..., description="The ID of the thread"),
-    user_message: UserMessage = Body(default=None)
+    user_message: UserMessage = Body(default=None),
+    idempotency_key: str = Header(default=None)
 ):
     try:
         logger.info(f"[Thread ID: {thread_id}] User: {user_message}")
 
+        if idempotency_key:
+            stored = thread_replies.get((thread_id, "idempotency", idempotency_key))
+            if stored is not None:
+                if wants_event_stream(request):
+                    return StreamingResponse(replay_thread_reply(stored), media_type="text/event-stream",
+                                             headers={"Cache-Control": "no-cache"})
+                return stored
+
+        # Job mode: enqueue and answer 202 right away; poll GET /jobs/{id} for the result
+        if wants_async_job(request):
+            job = reply_jobs.submit(thread_id, idempotency_key=idempotency_key)
+            return JSONResponse(
+                status_code=202,
+                content={"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"},
+                headers={"Location": f"/jobs/{job.id}"}
+            )
+
         # 1. Fetch the latest messages from the thread
         thread_messages, bot_info = await get_thread_info(thread_id)
 
-        # 2. Process messages and generate AI response
-        ai_response = get_chat_ai_response(thread_messages, bot_info)
-        logger.info(f"[Thread ID: {thread_id}] AI: {ai_response}")
+        # Streaming mode: send deltas as they arrive and persist once the stream ends
+        if wants_event_stream(request):
+            return StreamingResponse(
+                stream_thread_reply(thread_id, thread_messages, bot_info, idempotency_key),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
 
-        # 3. Add AI response to the thread
-        result = await post_to_instantdb(thread_id, ai_response)
-        
-        return {
-            "message": "AI response added to thread successfully",
-            "response": ai_response,
-            "id": result.get("id")
-        }
+        return await reply_once(
+            thread_id, thread_messages,
+            lambda: generate_thread_reply(thread_id, thread_messages, bot_info),
+            idempotency_key
+        )
+    except ModelBusyError as e:
+        return model_busy_response(e)
+    except QueueFullError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": "5"})
     except Exception as e:
         return {"error": str(e)}
 
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = reply_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
 @app.get("/callback")
 async def callback(code: str, state: str):
     return {"code": code, "state": state}
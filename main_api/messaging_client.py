@@ -0,0 +1,115 @@
+import asyncio
+import httpx
+import os
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+from metrics import percentile
+
+
+class MessagingClient:
+    """
+    Pooled HTTP client for the messaging service (bun, localhost:3000).
+
+    One httpx.AsyncClient is shared by every call so connections are kept alive
+    between requests. The FastAPI lifespan calls start() and close(); the client
+    is also created lazily so scripts can use it without the app running.
+    """
+
+    def __init__(self, base_url: str, max_connections: int = 50, max_keepalive: int = 20,
+                 timeout: float = 10.0, connect_timeout: float = 2.0):
+        self.base_url = base_url
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=30.0
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout, pool=connect_timeout)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._latencies = deque(maxlen=1000)
+        self._counters = {
+            "requests": 0,
+            "errors": 0,
+            "in_flight": 0,
+            "peak_in_flight": 0,
+            "clients_created": 0,
+            "retries": 0,
+        }
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, limits=self.limits, timeout=self.timeout)
+            self._counters["clients_created"] += 1
+        return self._client
+
+    async def start(self):
+        self.client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def request(self, method: str, path: str, timeout: float = None, **kwargs) -> httpx.Response:
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+
+        counters = self._counters
+        counters["requests"] += 1
+        counters["in_flight"] += 1
+        counters["peak_in_flight"] = max(counters["peak_in_flight"], counters["in_flight"])
+        started = time.perf_counter()
+        try:
+            return await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            counters["errors"] += 1
+            raise
+        finally:
+            counters["in_flight"] -= 1
+            self._latencies.append((time.perf_counter() - started) * 1000)
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, **kwargs)
+
+    async def post_with_retry(self, path: str, attempts: int = 3, backoff: float = 0.5, **kwargs) -> Optional[httpx.Response]:
+        """POST, retrying connection errors and 5xx responses with exponential backoff."""
+        for attempt in range(1, attempts + 1):
+            try:
+                response = await self.post(path, **kwargs)
+                if response.status_code < 500:
+                    return response
+                logger.warning(f"POST {path} returned {response.status_code} (attempt {attempt}/{attempts})")
+            except httpx.HTTPError as e:
+                logger.warning(f"POST {path} failed: {e} (attempt {attempt}/{attempts})")
+            if attempt < attempts:
+                self._counters["retries"] += 1
+                await asyncio.sleep(backoff * 2 ** (attempt - 1))
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = list(self._latencies)
+        return {
+            **self._counters,
+            "max_connections": self.limits.max_connections,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies) if latencies else None,
+            },
+        }
+
+
+messaging = MessagingClient(
+    os.getenv("MESSAGING_URL", "http://localhost:3000"),
+    max_connections=int(os.getenv("MESSAGING_MAX_CONNECTIONS", "50")),
+    max_keepalive=int(os.getenv("MESSAGING_MAX_KEEPALIVE", "20")),
+    timeout=float(os.getenv("MESSAGING_TIMEOUT", "10"))
+)
@@ -0,0 +1,9 @@
+from typing import Iterable, Optional
+
+
+def percentile(samples: Iterable[float], pct: float) -> Optional[float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
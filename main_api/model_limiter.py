@@ -0,0 +1,71 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+
+class ModelBusyError(Exception):
+    """Raised when a model already has too many requests waiting for a slot."""
+
+def parse_model_limits(value: str) -> Dict[str, int]:
+    # "gpt-4=8,microsoft/wizardlm-2-8x22b=32"
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        model, _, limit = item.rpartition("=")
+        limits[model] = int(limit)
+    return limits
+
+class ModelLimiter:
+    """
+    Caps in-flight completions per model and how many callers may queue behind them.
+    
+    Args:
+        default_concurrency: Concurrent requests allowed for models without an override
+        max_queue: Callers allowed to wait for a slot before ModelBusyError is raised
+        overrides: Per-model concurrency limits
+    """
+
+    def __init__(self, default_concurrency: int, max_queue: int, overrides: Dict[str, int] = None):
+        self.default_concurrency = default_concurrency
+        self.max_queue = max_queue
+        self.overrides = overrides or {}
+        self._models: Dict[str, Dict[str, Any]] = {}
+
+    def _state(self, model: str) -> Dict[str, Any]:
+        if model not in self._models:
+            limit = self.overrides.get(model, self.default_concurrency)
+            self._models[model] = {
+                "semaphore": asyncio.Semaphore(limit),
+                "limit": limit,
+                "in_flight": 0,
+                "waiting": 0,
+                "completed": 0,
+                "rejected": 0,
+            }
+        return self._models[model]
+
+    @asynccontextmanager
+    async def slot(self, model: str):
+        state = self._state(model)
+        if state["semaphore"].locked() and state["waiting"] >= self.max_queue:
+            state["rejected"] += 1
+            raise ModelBusyError(f"Too many pending requests for model {model}")
+
+        state["waiting"] += 1
+        try:
+            await state["semaphore"].acquire()
+        finally:
+            state["waiting"] -= 1
+
+        state["in_flight"] += 1
+        try:
+            yield
+        finally:
+            state["in_flight"] -= 1
+            state["completed"] += 1
+            state["semaphore"].release()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            model: {key: value for key, value in state.items() if key != "semaphore"}
+            for model, state in self._models.items()
+        }
@@ -0,0 +1,212 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, List
+
+from loguru import logger
+
+from metrics import percentile
+from model_limiter import ModelBusyError
+
+
+class AllModelsFailedError(Exception):
+    """Raised when every model in a fallback chain failed before its first token."""
+
+
+class ModelHealth:
+    """Rolling time-to-first-token, total latency and error samples for one model."""
+
+    def __init__(self, window: int = 200):
+        self.first_token = deque(maxlen=window)
+        self.total = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+
+    def record_first_token(self, seconds: float):
+        self.first_token.append(seconds)
+
+    def record_success(self, seconds: float):
+        self.total.append(seconds)
+        self.outcomes.append(True)
+
+    def record_error(self):
+        self.outcomes.append(False)
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "samples": len(self.outcomes),
+            "error_rate": self.error_rate,
+            "first_token_s": {
+                "p50": percentile(self.first_token, 50),
+                "p95": percentile(self.first_token, 95),
+                "p99": percentile(self.first_token, 99),
+            },
+            "total_s": {
+                "p50": percentile(self.total, 50),
+                "p95": percentile(self.total, 95),
+                "p99": percentile(self.total, 99),
+            },
+        }
+
+
+class ModelRouter:
+    """
+    Picks models for a chat turn, falls back along a chain and optionally hedges.
+
+    A bot's chain is its model followed by bot_info['fallbackModels'] (or the
+    default chain). Models whose recent error rate is above unhealthy_error_rate
+    are tried last. With hedging on, a second model is started if the first has
+    not produced a token within its p95 time-to-first-token, and whichever
+    streams first wins.
+
+    Args:
+        open_stream: (model, messages_for_model) -> async iterator of content deltas
+        default_fallbacks: Models tried after the bot's own model
+        hedge: Hedge by default when a bot does not say otherwise
+    """
+
+    def __init__(self, open_stream: Callable[[str, Any], AsyncIterator[str]], default_fallbacks: List[str] = None,
+                 hedge: bool = False, hedge_delay: float = 3.0, min_hedge_delay: float = 0.5,
+                 max_hedge_delay: float = 10.0, unhealthy_error_rate: float = 0.5, min_samples: int = 10):
+        self.open_stream = open_stream
+        self.default_fallbacks = default_fallbacks or []
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_delay = max_hedge_delay
+        self.unhealthy_error_rate = unhealthy_error_rate
+        self.min_samples = min_samples
+        self.health: Dict[str, ModelHealth] = {}
+        self.counters = {"fallbacks": 0, "hedges_fired": 0, "hedges_won": 0}
+
+    def _health(self, model: str) -> ModelHealth:
+        if model not in self.health:
+            self.health[model] = ModelHealth()
+        return self.health[model]
+
+    def _healthy(self, model: str) -> bool:
+        health = self._health(model)
+        return len(health.outcomes) < self.min_samples or health.error_rate <= self.unhealthy_error_rate
+
+    def chain(self, primary: str, bot_info: Dict[str, Any]) -> List[str]:
+        fallbacks = bot_info.get('fallbackModels', self.default_fallbacks)
+        models = list(dict.fromkeys([primary, *fallbacks]))
+        # Stable sort: healthy models keep their configured order ahead of unhealthy ones
+        return sorted(models, key=lambda model: not self._healthy(model))
+
+    def hedge_deadline(self, model: str) -> float:
+        samples = self._health(model).first_token
+        if len(samples) < self.min_samples:
+            return self.hedge_delay
+        return min(self.max_hedge_delay, max(self.min_hedge_delay, percentile(samples, 95)))
+
+    async def _tracked(self, model: str, messages: Any) -> AsyncIterator[str]:
+        health = self._health(model)
+        started = time.monotonic()
+        first = True
+        try:
+            async for delta in self.open_stream(model, messages):
+                if first:
+                    health.record_first_token(time.monotonic() - started)
+                    first = False
+                yield delta
+        except (asyncio.CancelledError, GeneratorExit):
+            # Hedge losers are cancelled; that says nothing about the model's health
+            if first:
+                # But the wait so far is a lower bound on its time to first token. Dropping
+                # it would leave only fast samples and pull the hedge deadline down.
+                health.record_first_token(time.monotonic() - started)
+            raise
+        except ModelBusyError:
+            # Our own limiter queue is full; the upstream model is not at fault
+            raise
+        except Exception:
+            health.record_error()
+            raise
+        health.record_success(time.monotonic() - started)
+
+    @staticmethod
+    async def _cancel(racers: Dict[asyncio.Future, Any]):
+        for task, (candidate, gen) in list(racers.items()):
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await gen.aclose()
+        racers.clear()
+
+    async def stream(self, primary: str, bot_info: Dict[str, Any], format_for: Callable[[str], Any]) -> AsyncIterator[str]:
+        """Yield deltas from the first model in the chain that starts answering."""
+        pending = self.chain(primary, bot_info)
+        hedge = bot_info.get('hedge', self.hedge)
+        errors: List[Exception] = []
+
+        while pending:
+            model = pending.pop(0)
+            racers = {}
+            winner = None
+
+            def start(candidate: str):
+                gen = self._tracked(candidate, format_for(candidate))
+                racers[asyncio.ensure_future(gen.__anext__())] = (candidate, gen)
+
+            try:
+                start(model)
+                if hedge and pending:
+                    done, _ = await asyncio.wait(set(racers), timeout=self.hedge_deadline(model))
+                    if not done:
+                        self.counters["hedges_fired"] += 1
+                        logger.info(f"Hedging {model} with {pending[0]}")
+                        start(pending.pop(0))
+
+                while racers and winner is None:
+                    done, _ = await asyncio.wait(set(racers), return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        candidate, gen = racers.pop(task)
+                        error = task.exception()
+                        if error is None or isinstance(error, StopAsyncIteration):
+                            if winner is None:
+                                winner = (candidate, gen, None if error else task.result())
+                            else:
+                                await gen.aclose()
+                        else:
+                            logger.warning(f"Model {candidate} failed before its first token: {error}")
+                            errors.append(error)
+            except BaseException:
+                if winner is not None:
+                    await winner[1].aclose()
+                raise
+            finally:
+                # Also runs when the caller is cancelled mid-race, so no racer keeps its slot or request
+                await self._cancel(racers)
+
+            if winner is None:
+                if pending:
+                    self.counters["fallbacks"] += 1
+                continue
+
+            candidate, gen, first_delta = winner
+            if candidate != model:
+                self.counters["hedges_won"] += 1
+            try:
+                if first_delta is None:
+                    return
+                yield first_delta
+                async for delta in gen:
+                    yield delta
+                return
+            finally:
+                await gen.aclose()
+
+        if errors and all(isinstance(error, ModelBusyError) for error in errors):
+            raise errors[-1]
+        raise AllModelsFailedError("; ".join(str(error) for error in errors) or "No models configured")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "models": {model: health.stats() for model, health in self.health.items()},
+        }
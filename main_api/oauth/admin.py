@@ -0,0 +1,118 @@
+import json
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession as DBSession
+
+from oauth.database import AsyncSession
+from oauth.models import ClientDB, UserDB, UserSession
+from ttl_cache import TTLCache
+
+PAGE_SIZE = int(os.getenv("OAUTH_ADMIN_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.getenv("OAUTH_ADMIN_MAX_PAGE_SIZE", "500"))
+EXPORT_BATCH_SIZE = int(os.getenv("OAUTH_ADMIN_EXPORT_BATCH", "1000"))
+
+# Exact COUNT(*) walks the whole table, so admin pages show a cached figure
+approximate_counts = TTLCache(maxsize=16, ttl=float(os.getenv("OAUTH_ADMIN_COUNT_TTL", "60")))
+
+# name -> (select of the columns shown, keyset column, extra filter)
+ADMIN_VIEWS = {
+    "users": (
+        select(UserDB.id, UserDB.username, UserDB.display_name, UserDB.email),
+        UserDB.id,
+        None,
+    ),
+    "clients": (
+        select(ClientDB.client_id, ClientDB.name, ClientDB.redirect_uri),
+        ClientDB.client_id,
+        None,
+    ),
+    "sessions": (
+        select(UserSession.id, UserSession.session_id, UserSession.user_id, UserSession.is_active),
+        UserSession.id,
+        None,
+    ),
+    "active_sessions": (
+        select(UserSession.id, UserSession.session_id, UserDB.id.label("user_id"), UserDB.username,
+               UserDB.display_name, UserDB.email).join(UserDB, UserSession.user_id == UserDB.id),
+        UserSession.id,
+        UserSession.is_active == 1,
+    ),
+}
+
+
+def page_size(limit: Optional[int]) -> int:
+    return max(1, min(limit or PAGE_SIZE, MAX_PAGE_SIZE))
+
+
+def _cursor_value(view: str, after: Optional[str]):
+    if after is None:
+        return None
+    key = ADMIN_VIEWS[view][1]
+    return int(after) if key.type.python_type is int else after
+
+
+async def keyset_page(session: DBSession, view: str, after: Optional[str] = None,
+                limit: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    One page of a view ordered by its key, starting after the `after` cursor.
+
+    Returns (rows, next cursor); the cursor is None on the last page. Seeks on the
+    key index instead of OFFSET, so every page costs the same however deep it is.
+    """
+    query, key, condition = ADMIN_VIEWS[view]
+    limit = page_size(limit)
+    if condition is not None:
+        query = query.where(condition)
+    cursor = _cursor_value(view, after)
+    if cursor is not None:
+        query = query.where(key > cursor)
+    # One extra row tells us whether there is a next page
+    result = await session.execute(query.order_by(key).limit(limit + 1))
+    rows = [dict(row) for row in result.mappings()]
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, str(rows[-1][key.key])
+
+
+async def approximate_count(session: DBSession, view: str) -> int:
+    count = approximate_counts.get(view)
+    if count is not None:
+        return count
+
+    query, _, condition = ADMIN_VIEWS[view]
+    table = query.get_final_froms()[0]
+    if session.bind.dialect.name == "postgresql" and condition is None:
+        # Planner statistics; refreshed by autovacuum and the sweeper's VACUUM ANALYZE
+        count = await session.scalar(
+            text("SELECT reltuples::bigint FROM pg_class WHERE relname = :name"), {"name": table.name}
+        ) or 0
+    else:
+        counted = select(func.count()).select_from(table)
+        if condition is not None:
+            counted = counted.where(condition)
+        count = await session.scalar(counted)
+    count = max(int(count), 0)
+    approximate_counts.set(view, count)
+    return count
+
+
+async def export_ndjson(views: List[str]) -> AsyncIterator[str]:
+    """
+    Yield every row of the given views as newline-delimited JSON, in key order.
+
+    Rows are fetched EXPORT_BATCH_SIZE at a time through a server-side cursor on a
+    session of its own, so memory stays flat and the request session is not held.
+    """
+    async with AsyncSession() as session:
+        for view in views:
+            query, key, condition = ADMIN_VIEWS[view]
+            if condition is not None:
+                query = query.where(condition)
+            result = await session.stream(
+                query.order_by(key).execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            async for row in result.mappings():
+                yield json.dumps({"table": view, **row}, default=str) + "\n"
@@ -0,0 +1,184 @@
+import heapq
+import json
+import os
+import secrets
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    # redis is optional; only needed when OAUTH_AUTH_CODE_STORE=redis
+    redis = None
+
+
+class AuthCode(NamedTuple):
+    client_id: str
+    user_id: int
+
+
+def generate_code() -> str:
+    return secrets.token_urlsafe(32)
+
+
+class MemoryAuthCodeStore:
+    """
+    Authorization codes held in this process with a TTL.
+
+    `take` pops the code in one step with no await in between, so of two
+    concurrent redemptions exactly one gets it. Expiry times sit in a min-heap
+    that is drained as codes are issued, so expired codes are dropped without a
+    background task. Codes only live in the worker that issued them: use the
+    redis store when more than one worker serves /oauth2.
+    """
+
+    def __init__(self, ttl: float = 600, maxsize: int = 100000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._codes: Dict[str, Tuple[AuthCode, float]] = {}
+        self._expiry: List[Tuple[float, str]] = []
+        self._counters = {"issued": 0, "redeemed": 0, "missing": 0, "expired": 0, "evicted": 0}
+
+    def _expire(self, now: float):
+        while self._expiry and self._expiry[0][0] <= now:
+            _, code = heapq.heappop(self._expiry)
+            # Redeemed codes leave their heap entry behind
+            if self._codes.pop(code, None) is not None:
+                self._counters["expired"] += 1
+        if len(self._expiry) > 2 * len(self._codes) + 1024:
+            # Mostly entries of redeemed codes; rebuild from the live ones
+            self._expiry = [(expires, code) for expires, code in self._expiry if code in self._codes]
+            heapq.heapify(self._expiry)
+
+    def _evict(self):
+        while len(self._codes) >= self.maxsize and self._expiry:
+            _, code = heapq.heappop(self._expiry)
+            if self._codes.pop(code, None) is not None:
+                self._counters["evicted"] += 1
+                logger.warning("Auth code store full, dropped the code closest to expiry")
+
+    async def issue(self, client_id: str, user_id: int) -> str:
+        now = time.monotonic()
+        self._expire(now)
+        self._evict()
+        code = generate_code()
+        expires = now + self.ttl
+        self._codes[code] = (AuthCode(client_id, user_id), expires)
+        heapq.heappush(self._expiry, (expires, code))
+        self._counters["issued"] += 1
+        return code
+
+    async def take(self, code: str) -> Optional[AuthCode]:
+        """Remove and return the code; None if it is unknown, used or expired."""
+        entry = self._codes.pop(code, None)
+        if entry is None:
+            self._counters["missing"] += 1
+            return None
+        auth_code, expires = entry
+        if expires <= time.monotonic():
+            self._counters["expired"] += 1
+            return None
+        self._counters["redeemed"] += 1
+        return auth_code
+
+    def clear(self):
+        self._codes.clear()
+        self._expiry.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"type": "memory", **self._counters, "size": len(self._codes), "heap": len(self._expiry)}
+
+
+class RedisAuthCodeStore:
+    """Authorization codes shared by every worker through Redis; GETDEL makes redemption take-once."""
+
+    def __init__(self, url: str, ttl: float = 600, prefix: str = "oauth:code:"):
+        if redis is None:
+            raise RuntimeError("OAUTH_AUTH_CODE_STORE=redis needs the redis package")
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self._counters = {"issued": 0, "redeemed": 0, "missing": 0}
+
+    async def issue(self, client_id: str, user_id: int) -> str:
+        code = generate_code()
+        value = json.dumps({"client_id": client_id, "user_id": user_id})
+        await self.client.set(self.prefix + code, value, px=int(self.ttl * 1000))
+        self._counters["issued"] += 1
+        return code
+
+    async def take(self, code: str) -> Optional[AuthCode]:
+        # Redis drops the key itself once the TTL passes
+        value = await self.client.getdel(self.prefix + code)
+        if value is None:
+            self._counters["missing"] += 1
+            return None
+        self._counters["redeemed"] += 1
+        return AuthCode(**json.loads(value))
+
+    def clear(self):
+        # Other workers share these codes; they expire on their own
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"type": "redis", **self._counters}
+
+
+class SQLAuthCodeStore:
+    """Authorization codes in the auth_codes table; the sweeper deletes expired rows."""
+
+    def __init__(self, async_engine: AsyncEngine, ttl: float = 600):
+        self.async_engine = async_engine
+        self.ttl = ttl
+        self._counters = {"issued": 0, "redeemed": 0, "missing": 0, "expired": 0}
+
+    async def issue(self, client_id: str, user_id: int) -> str:
+        code = generate_code()
+        async with self.async_engine.begin() as conn:
+            await conn.execute(
+                text("INSERT INTO auth_codes (code, client_id, user_id, expires_at) "
+                     "VALUES (:code, :client_id, :user_id, :expires_at)"),
+                {"code": code, "client_id": client_id, "user_id": user_id,
+                 "expires_at": datetime.utcnow() + timedelta(seconds=self.ttl)}
+            )
+        self._counters["issued"] += 1
+        return code
+
+    async def take(self, code: str) -> Optional[AuthCode]:
+        # DELETE ... RETURNING lets only one of two concurrent redemptions see the row
+        async with self.async_engine.begin() as conn:
+            row = (await conn.execute(
+                text("DELETE FROM auth_codes WHERE code = :code RETURNING client_id, user_id, expires_at"),
+                {"code": code}
+            )).first()
+        if row is None:
+            self._counters["missing"] += 1
+            return None
+        expires_at = row[2] if isinstance(row[2], datetime) else datetime.fromisoformat(row[2])
+        if expires_at < datetime.utcnow():
+            self._counters["expired"] += 1
+            return None
+        self._counters["redeemed"] += 1
+        return AuthCode(row[0], row[1])
+
+    def clear(self):
+        # The table is dropped and recreated along with the rest
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"type": "sql", **self._counters}
+
+
+def create_auth_code_store(async_engine: AsyncEngine):
+    ttl = float(os.getenv("OAUTH_AUTH_CODE_TTL", "600"))
+    kind = os.getenv("OAUTH_AUTH_CODE_STORE", "memory")
+    if kind == "redis":
+        return RedisAuthCodeStore(os.getenv("OAUTH_AUTH_CODE_REDIS_URL", "redis://localhost:6379/0"), ttl=ttl)
+    if kind == "sql":
+        return SQLAuthCodeStore(async_engine, ttl=ttl)
+    return MemoryAuthCodeStore(ttl=ttl, maxsize=int(os.getenv("OAUTH_AUTH_CODE_MAX", "100000")))
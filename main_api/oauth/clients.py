@@ -0,0 +1,119 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from typing import Any, Dict, NamedTuple, Optional
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+def hash_client_secret(secret: str) -> str:
+    # Secrets are random UUIDs, far beyond brute force, so a fast hash is enough
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+_VERSION = text("SELECT version FROM registry_versions WHERE name = 'clients'")
+_ALL_CLIENTS = text("SELECT client_id, secret_hash, redirect_uri, name FROM clients")
+_ONE_CLIENT = text("SELECT client_id, secret_hash, redirect_uri, name FROM clients WHERE client_id = :client_id")
+
+
+class Client(NamedTuple):
+    client_id: str
+    secret_hash: str
+    redirect_uri: str
+    name: str
+
+    def verify_secret(self, secret: Optional[str]) -> bool:
+        if not secret or not self.secret_hash:
+            return False
+        return hmac.compare_digest(self.secret_hash, hash_client_secret(secret))
+
+
+class ClientRegistry:
+    """
+    Every registered client held in memory, so token and authorize calls skip the clients table.
+
+    Registrations bump a counter in registry_versions in the same transaction. Each
+    worker reads that counter at most every `check_interval` seconds and reloads the
+    registry when it moved; an unknown client_id is looked up directly so a client
+    registered on another worker works straight away.
+
+    `engine` serves the blocking load at startup; request paths use `async_engine`.
+    """
+
+    def __init__(self, engine: Engine, async_engine: AsyncEngine, check_interval: float = 5.0):
+        self.engine = engine
+        self.async_engine = async_engine
+        self.check_interval = check_interval
+        self._clients: Dict[str, Client] = {}
+        self._version: Optional[int] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "reloads": 0, "version_checks": 0}
+
+    def _install(self, rows, version: int):
+        with self._lock:
+            self._clients = {row[0]: Client(*row) for row in rows}
+            self._version = version
+            self._counters["reloads"] += 1
+        logger.info(f"Loaded {len(rows)} OAuth clients (registry version {version})")
+
+    def load(self):
+        """Load every client; called at startup and after the tables are recreated."""
+        with self.engine.connect() as conn:
+            version = conn.execute(_VERSION).scalar() or 0
+            rows = conn.execute(_ALL_CLIENTS).all()
+        self._install(rows, version)
+        self._next_check = time.monotonic() + self.check_interval
+
+    async def _check_version(self):
+        # Claim the check first so concurrent requests do not all run it
+        self._next_check = time.monotonic() + self.check_interval
+        self._counters["version_checks"] += 1
+        async with self.async_engine.connect() as conn:
+            version = (await conn.execute(_VERSION)).scalar() or 0
+            if version != self._version:
+                rows = (await conn.execute(_ALL_CLIENTS)).all()
+                self._install(rows, version)
+
+    async def get(self, client_id: str) -> Optional[Client]:
+        if time.monotonic() >= self._next_check:
+            await self._check_version()
+
+        client = self._clients.get(client_id)
+        if client is not None:
+            self._counters["hits"] += 1
+            return client
+
+        self._counters["misses"] += 1
+        async with self.async_engine.connect() as conn:
+            row = (await conn.execute(_ONE_CLIENT, {"client_id": client_id})).first()
+        if row is None:
+            return None
+        client = Client(*row)
+        self._clients[client_id] = client
+        return client
+
+    async def register(self, client_id: str, secret: str, name: str, redirect_uri: str) -> Client:
+        """Store a new client; only the secret's hash is kept."""
+        client = Client(client_id, hash_client_secret(secret), redirect_uri, name)
+        async with self.async_engine.begin() as conn:
+            await conn.execute(
+                text("INSERT INTO clients (client_id, secret_hash, redirect_uri, name) "
+                     "VALUES (:client_id, :secret_hash, :redirect_uri, :name)"),
+                client._asdict()
+            )
+            await conn.execute(text("UPDATE registry_versions SET version = version + 1 WHERE name = 'clients'"))
+        self._clients[client.client_id] = client
+        return client
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._counters, "size": len(self._clients), "version": self._version}
+
+
+def create_client_registry(engine: Engine, async_engine: AsyncEngine) -> ClientRegistry:
+    return ClientRegistry(engine, async_engine, check_interval=float(os.getenv("OAUTH_CLIENT_REGISTRY_CHECK", "5")))
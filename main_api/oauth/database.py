@@ -0,0 +1,75 @@
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+# sqlite:///ara.db by default; point OAUTH_DATABASE_URL at Postgres (postgresql+psycopg://...) in production
+DATABASE_URL = os.getenv("OAUTH_DATABASE_URL", "sqlite:///ara.db")
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+
+def _async_url(url: str) -> str:
+    # Request handlers use an async driver: aiosqlite for SQLite, asyncpg for Postgres
+    driver, _, rest = url.partition("://")
+    if driver == "sqlite":
+        return f"sqlite+aiosqlite://{rest}"
+    if driver in ("postgresql", "postgresql+psycopg2"):
+        return f"postgresql+asyncpg://{rest}"
+    return url
+
+
+ASYNC_DATABASE_URL = os.getenv("OAUTH_ASYNC_DATABASE_URL", _async_url(DATABASE_URL))
+
+# Applied to every new SQLite connection
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # readers no longer block the writer
+    "synchronous": "NORMAL",  # durable at checkpoints, safe with WAL
+    "cache_size": -int(os.getenv("OAUTH_SQLITE_CACHE_KB", "20000")),  # negative means KiB
+    "busy_timeout": int(os.getenv("OAUTH_SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+}
+
+
+def _engine_options(is_async: bool = False) -> dict:
+    options = {
+        "pool_size": int(os.getenv("OAUTH_DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("OAUTH_DB_MAX_OVERFLOW", "20")),
+        "pool_timeout": float(os.getenv("OAUTH_DB_POOL_TIMEOUT", "10")),
+    }
+    if not IS_SQLITE:
+        options["pool_pre_ping"] = True
+        options["pool_recycle"] = 1800
+    elif not is_async:
+        # Pooled connections are handed between threadpool threads
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+Base = declarative_base()
+
+# Sync engine for migrations, the sweeper thread, startup loads and scripts
+engine = create_engine(DATABASE_URL, **_engine_options())
+Session = sessionmaker(bind=engine)
+
+# Async engine for request handlers, so OAuth routes never occupy threadpool slots
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_engine_options(is_async=True))
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+if IS_SQLITE:
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
+
+async def get_db():
+    """FastAPI dependency: one AsyncSession per request, always closed."""
+    async with AsyncSession() as session:
+        yield session
@@ -0,0 +1,247 @@
+"""
+Versioned schema migrations for the OAuth database.
+
+Each migration runs once, in order, inside its own transaction and is recorded in
+the schema_version table. Migrations must never drop data (migration 6 discarding
+plaintext client secrets is the one deliberate exception); add a new one instead of
+editing an applied one.
+
+    python -m oauth.migrations            # apply pending migrations
+    python -m oauth.migrations status     # show applied / pending versions
+    python -m oauth.migrations check      # fail if a hot query scans a whole table
+"""
+import base64
+import hashlib
+import json
+import sys
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from loguru import logger
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, text
+from sqlalchemy.engine import Connection, Engine
+
+
+def _initial_schema(conn: Connection):
+    # Frozen copy of the original tables; later changes belong in later migrations
+    metadata = MetaData()
+    Table("clients", metadata,
+          Column("client_id", String, primary_key=True),
+          Column("client_secret", String),
+          Column("redirect_uri", String),
+          Column("name", String))
+    Table("users", metadata,
+          Column("id", Integer, primary_key=True),
+          Column("username", String, unique=True),
+          Column("password", String),
+          Column("display_name", String),
+          Column("email", String, unique=True))
+    Table("auth_codes", metadata,
+          Column("code", String, primary_key=True),
+          Column("client_id", String),
+          Column("user_id", Integer),
+          Column("expires_at", DateTime))
+    Table("tokens", metadata,
+          Column("access_token", String, primary_key=True),
+          Column("refresh_token", String),
+          Column("user_id", Integer),
+          Column("client_id", String),
+          Column("expires_at", DateTime))
+    Table("user_sessions", metadata,
+          Column("id", Integer, primary_key=True),
+          Column("user_id", Integer),
+          Column("session_id", String, unique=True),
+          Column("client_id", String),
+          Column("created_at", DateTime),
+          Column("last_active", DateTime),
+          Column("is_active", Integer))
+    # checkfirst leaves tables of pre-migration databases untouched
+    metadata.create_all(conn, checkfirst=True)
+
+
+def _hot_lookup_indexes(conn: Connection):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_tokens_refresh_token_client_id ON tokens (refresh_token, client_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_user_sessions_is_active_user_id ON user_sessions (is_active, user_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_auth_codes_expires_at ON auth_codes (expires_at)"))
+
+
+def _sweeper_indexes(conn: Connection):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_tokens_expires_at ON tokens (expires_at)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_user_sessions_is_active_last_active ON user_sessions (is_active, last_active)"))
+
+
+def _browser_scoped_sessions(conn: Connection):
+    conn.execute(text("ALTER TABLE user_sessions ADD COLUMN browser_id VARCHAR"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_user_sessions_browser_id_is_active ON user_sessions (browser_id, is_active)"))
+
+
+def _revoked_tokens(conn: Connection):
+    Table("revoked_tokens", MetaData(),
+          Column("token_hash", String, primary_key=True),
+          Column("expires_at", DateTime),
+          Column("revoked_at", DateTime)).create(conn, checkfirst=True)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_revoked_tokens_expires_at ON revoked_tokens (expires_at)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_revoked_tokens_revoked_at ON revoked_tokens (revoked_at)"))
+
+
+def _hashed_client_secrets(conn: Connection):
+    conn.execute(text("ALTER TABLE clients ADD COLUMN secret_hash VARCHAR"))
+    # Deliberately discards the plaintext secrets; only their hashes are kept
+    for client_id, secret in conn.execute(text("SELECT client_id, client_secret FROM clients")).all():
+        conn.execute(text("UPDATE clients SET secret_hash = :secret_hash, client_secret = NULL WHERE client_id = :client_id"),
+                     {"secret_hash": hashlib.sha256(secret.encode()).hexdigest() if secret else None, "client_id": client_id})
+    Table("registry_versions", MetaData(),
+          Column("name", String, primary_key=True),
+          Column("version", Integer)).create(conn, checkfirst=True)
+    conn.execute(text("INSERT INTO registry_versions (name, version) VALUES ('clients', 0)"))
+
+
+def _digest(value: str) -> str:
+    # Frozen copy of oauth.server.hash_token
+    return base64.urlsafe_b64encode(hashlib.sha256(value.encode()).digest()[:16]).decode().rstrip("=")
+
+
+def _legacy_jti(access_token: str) -> str:
+    # The jti claim when the token has one, otherwise a digest of the whole token
+    try:
+        claims = access_token.split(".")[1]
+        jti = json.loads(base64.urlsafe_b64decode(claims + "=" * (-len(claims) % 4))).get("jti")
+    except (IndexError, ValueError):
+        jti = None
+    return jti or _digest(access_token)
+
+
+def _compact_tokens(conn: Connection):
+    Table("tokens_v7", MetaData(),
+          Column("jti", String, primary_key=True),
+          Column("refresh_token_hash", String),
+          Column("user_id", Integer),
+          Column("client_id", String),
+          Column("expires_at", DateTime)).create(conn)
+    rows = conn.execute(text("SELECT access_token, refresh_token, user_id, client_id, expires_at FROM tokens"))
+    insert = text("INSERT INTO tokens_v7 (jti, refresh_token_hash, user_id, client_id, expires_at) "
+                  "VALUES (:jti, :refresh_token_hash, :user_id, :client_id, :expires_at)")
+    while True:
+        batch = rows.fetchmany(1000)
+        if not batch:
+            break
+        conn.execute(insert, [
+            {"jti": _legacy_jti(access_token), "refresh_token_hash": _digest(refresh_token) if refresh_token else None,
+             "user_id": user_id, "client_id": client_id, "expires_at": expires_at}
+            for access_token, refresh_token, user_id, client_id, expires_at in batch
+        ])
+    conn.execute(text("DROP TABLE tokens"))
+    conn.execute(text("ALTER TABLE tokens_v7 RENAME TO tokens"))
+    conn.execute(text("CREATE UNIQUE INDEX ix_tokens_refresh_token_hash ON tokens (refresh_token_hash)"))
+    conn.execute(text("CREATE INDEX ix_tokens_expires_at ON tokens (expires_at)"))
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "initial schema", _initial_schema),
+    (2, "indexes for refresh grants, session lookups and code expiry", _hot_lookup_indexes),
+    (3, "indexes for the expiry sweeper", _sweeper_indexes),
+    (4, "browser id on user sessions for the account picker", _browser_scoped_sessions),
+    (5, "revoked token ids for introspection", _revoked_tokens),
+    (6, "hashed client secrets and a client registry version", _hashed_client_secrets),
+    (7, "tokens keyed by jti with hashed refresh tokens", _compact_tokens),
+]
+
+_schema_version = Table(
+    "schema_version", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String),
+    Column("applied_at", DateTime),
+)
+
+
+def applied_versions(engine: Engine) -> List[int]:
+    with engine.begin() as conn:
+        _schema_version.create(conn, checkfirst=True)
+        return [row[0] for row in conn.execute(_schema_version.select().order_by(_schema_version.c.version))]
+
+
+def migrate(engine: Engine) -> List[int]:
+    """Apply pending migrations and return the versions that were applied."""
+    done = set(applied_versions(engine))
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as conn:
+            upgrade(conn)
+            conn.execute(_schema_version.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()
+            ))
+        logger.info(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def drop_schema_version(engine: Engine):
+    with engine.begin() as conn:
+        _schema_version.drop(conn, checkfirst=True)
+
+
+# Lookups on request paths; each must be served by an index as tables grow
+HOT_QUERIES = {
+    "refresh token grant": "SELECT * FROM tokens WHERE refresh_token_hash = :a",
+    "logout by session id": "SELECT * FROM user_sessions WHERE session_id = :a",
+    "active sessions": "SELECT * FROM user_sessions JOIN users ON user_sessions.user_id = users.id WHERE user_sessions.is_active = 1",
+    "account picker": "SELECT * FROM user_sessions JOIN users ON user_sessions.user_id = users.id WHERE user_sessions.browser_id = :a AND user_sessions.is_active = 1",
+    "expired auth codes": "SELECT code FROM auth_codes WHERE expires_at < :a",
+    "login by username": "SELECT * FROM users WHERE username = :a",
+    "client lookup": "SELECT * FROM clients WHERE client_id = :a",
+    "client registry version": "SELECT version FROM registry_versions WHERE name = 'clients'",
+    "auth code lookup": "SELECT * FROM auth_codes WHERE code = :a",
+    "sweep dead tokens": "SELECT jti FROM tokens WHERE expires_at < :a LIMIT 500",
+    "dashboard sessions page": "SELECT * FROM user_sessions JOIN users ON user_sessions.user_id = users.id WHERE user_sessions.is_active = 1 AND user_sessions.id > :a ORDER BY user_sessions.id LIMIT 51",
+    "revocation check": "SELECT 1 FROM revoked_tokens WHERE token_hash = :a",
+    "revocation refresh": "SELECT token_hash, expires_at, revoked_at FROM revoked_tokens WHERE expires_at > :a AND revoked_at >= :b",
+    "sweep revoked tokens": "SELECT token_hash FROM revoked_tokens WHERE expires_at < :a LIMIT 500",
+    "sweep inactive sessions": "SELECT id FROM user_sessions WHERE is_active = 0 AND last_active < :a LIMIT 500",
+}
+
+
+def check_query_plans(engine: Engine) -> List[str]:
+    """Return a description of every hot query whose SQLite plan scans a whole table."""
+    if engine.dialect.name != "sqlite":
+        return []
+
+    problems = []
+    with engine.connect() as conn:
+        for name, sql in HOT_QUERIES.items():
+            params = {key: None for key in ("a", "b") if f":{key}" in sql}
+            plan = [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"), params)]
+            # "SCAN t" is a full table scan; "SCAN t USING (COVERING) INDEX" walks an index
+            scans = [step for step in plan if step.startswith("SCAN") and "INDEX" not in step]
+            if scans:
+                problems.append(f"{name}: {'; '.join(scans)}")
+    return problems
+
+
+def main(argv: List[str]) -> int:
+    from oauth.database import engine
+
+    command = argv[0] if argv else "upgrade"
+    if command == "upgrade":
+        applied = migrate(engine)
+        print(f"Applied {applied}" if applied else "Already up to date")
+    elif command == "status":
+        done = set(applied_versions(engine))
+        for version, description, _ in MIGRATIONS:
+            print(f"{'applied' if version in done else 'pending':>8}  {version:>3}  {description}")
+    elif command == "check":
+        migrate(engine)
+        problems = check_query_plans(engine)
+        for problem in problems:
+            print(f"FULL SCAN  {problem}")
+        print("All hot queries use indexes" if not problems else f"{len(problems)} hot queries scan full tables")
+        return 1 if problems else 0
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,75 @@
+from sqlalchemy import Column, String, Integer, DateTime, Index
+from datetime import datetime
+
+from oauth.database import Base
+
+class ClientDB(Base):
+    __tablename__ = "clients"
+    client_id = Column(String, primary_key=True)
+    client_secret = Column(String)  # plaintext, emptied by migration 6; use secret_hash
+    secret_hash = Column(String)
+    redirect_uri = Column(String)
+    name = Column(String)
+
+class RegistryVersionDB(Base):
+    __tablename__ = "registry_versions"
+    name = Column(String, primary_key=True)
+    version = Column(Integer, default=0)
+
+class UserDB(Base):
+    __tablename__ = "users"
+    id = Column(Integer, primary_key=True)
+    username = Column(String, unique=True)
+    password = Column(String)
+    display_name = Column(String)
+    email = Column(String, unique=True)
+
+class AuthCodeDB(Base):
+    __tablename__ = "auth_codes"
+    code = Column(String, primary_key=True)
+    client_id = Column(String)
+    user_id = Column(Integer)
+    expires_at = Column(DateTime)
+
+    __table_args__ = (Index("ix_auth_codes_expires_at", "expires_at"),)
+
+class TokenDB(Base):
+    __tablename__ = "tokens"
+    jti = Column(String, primary_key=True)  # the access token's jti claim
+    refresh_token_hash = Column(String)  # hash_token() of the refresh token
+    user_id = Column(Integer)
+    client_id = Column(String)
+    expires_at = Column(DateTime)  # of the access token
+
+    __table_args__ = (
+        Index("ix_tokens_refresh_token_hash", "refresh_token_hash", unique=True),
+        Index("ix_tokens_expires_at", "expires_at"),
+    )
+
+class UserSession(Base):
+    __tablename__ = "user_sessions"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    session_id = Column(String, unique=True)
+    client_id = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_active = Column(DateTime, default=datetime.utcnow)
+    is_active = Column(Integer, default=1)
+    browser_id = Column(String)
+
+    __table_args__ = (
+        Index("ix_user_sessions_is_active_user_id", "is_active", "user_id"),
+        Index("ix_user_sessions_is_active_last_active", "is_active", "last_active"),
+        Index("ix_user_sessions_browser_id_is_active", "browser_id", "is_active"),
+    )
+
+class RevokedTokenDB(Base):
+    __tablename__ = "revoked_tokens"
+    token_hash = Column(String, primary_key=True)  # sha256 of the token
+    expires_at = Column(DateTime)
+    revoked_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_revoked_tokens_expires_at", "expires_at"),
+        Index("ix_revoked_tokens_revoked_at", "revoked_at"),
+    )
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from passlib.context import CryptContext
+
+from metrics import percentile
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when the password pool's queue is full; callers should answer 503."""
+
+
+def _timed(fn: Callable, *args):
+    # Runs in the worker process; time.monotonic is system-wide so queue time can be derived
+    started = time.monotonic()
+    result = fn(*args)
+    return result, started, time.monotonic() - started
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(password: str, hashed: str) -> bool:
+    return pwd_context.verify(password, hashed)
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt hashing and verification on a small dedicated process pool.
+
+    bcrypt is deliberately CPU-heavy; doing it inline holds the GIL and stalls every
+    other route on the worker. At most `workers + max_queue` operations are
+    accepted at once and the rest fail fast with PasswordPoolBusy.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 32):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+        self._queue_ms = deque(maxlen=1000)
+        self._exec_ms = deque(maxlen=1000)
+        self._counters = {"completed": 0, "rejected": 0}
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, fn: Callable, *args) -> Any:
+        if self._pending >= self.workers + self.max_queue:
+            self._counters["rejected"] += 1
+            raise PasswordPoolBusy("Too many password operations in progress")
+
+        self._pending += 1
+        submitted = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            result, started, exec_seconds = await loop.run_in_executor(self.executor, _timed, fn, *args)
+        finally:
+            self._pending -= 1
+
+        self._queue_ms.append((started - submitted) * 1000)
+        self._exec_ms.append(exec_seconds * 1000)
+        self._counters["completed"] += 1
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(_verify, password, hashed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._counters,
+            "pending": self._pending,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queue_ms": {"p50": percentile(self._queue_ms, 50), "p95": percentile(self._queue_ms, 95)},
+            "exec_ms": {"p50": percentile(self._exec_ms, 50), "p95": percentile(self._exec_ms, 95)},
+        }
+
+
+password_hasher = PasswordHasher(
+    workers=int(os.getenv("OAUTH_PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    max_queue=int(os.getenv("OAUTH_PASSWORD_QUEUE", "32"))
+)
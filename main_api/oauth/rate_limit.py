@@ -0,0 +1,161 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    # redis is optional; only needed when OAUTH_RATE_LIMIT_STORE=redis
+    redis = None
+
+
+class RateLimited(Exception):
+    """Raised when a request has no tokens left in one of its buckets."""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded for {scope}")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+def parse_rate(value: str) -> Tuple[float, float]:
+    # "10/60" -> bursts of 10, refilled at 10 per 60 seconds
+    count, _, seconds = value.partition("/")
+    capacity = float(count)
+    return capacity, capacity / float(seconds or 1)
+
+
+class MemoryBucketStore:
+    """Token buckets in this process; idle keys are evicted first once maxsize is reached."""
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, capacity: float, rate: float, cost: float = 1) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            # An evicted bucket comes back full, the same as a long-idle one
+            self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (cost - tokens) / rate
+
+    def stats(self) -> Dict[str, Any]:
+        return {"type": "memory", "keys": len(self._buckets)}
+
+
+# Refill and take atomically on the Redis server, using its clock so workers agree
+_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(retry_after)}
+"""
+
+
+class RedisBucketStore:
+    """Token buckets shared by every worker through Redis."""
+
+    def __init__(self, url: str, prefix: str = "oauth:rl:"):
+        if redis is None:
+            raise RuntimeError("OAUTH_RATE_LIMIT_STORE=redis needs the redis package")
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(_TAKE_SCRIPT)
+
+    async def take(self, key: str, capacity: float, rate: float, cost: float = 1) -> Tuple[bool, float]:
+        allowed, retry_after = await self._take(keys=[self.prefix + key], args=[capacity, rate, cost])
+        return bool(allowed), float(retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"type": "redis"}
+
+
+class RateLimiter:
+    """
+    Token-bucket limits per scope (ip, username, client_id) checked before any real work.
+
+    Each scope has its own (capacity, refill rate); a request draws one token from
+    the bucket of every scope it carries and is rejected with RateLimited if any of
+    them is empty. If the store fails the request is let through, so an outage of a
+    shared store never locks users out.
+
+    Args:
+        store: MemoryBucketStore or RedisBucketStore
+        rules: scope -> (capacity, tokens added per second)
+    """
+
+    def __init__(self, store, rules: Dict[str, Tuple[float, float]], enabled: bool = True):
+        self.store = store
+        self.rules = rules
+        self.enabled = enabled
+        self._counters = {"allowed": 0, "store_errors": 0}
+        self._rejected = {scope: 0 for scope in rules}
+
+    async def check(self, **keys: Optional[str]):
+        if not self.enabled:
+            return
+        for scope, value in keys.items():
+            if value is None or scope not in self.rules:
+                continue
+            capacity, rate = self.rules[scope]
+            try:
+                allowed, retry_after = await self.store.take(f"{scope}:{value}", capacity, rate)
+            except Exception as e:
+                self._counters["store_errors"] += 1
+                logger.warning(f"Rate limit store failed, allowing request: {e}")
+                continue
+            if not allowed:
+                self._rejected[scope] += 1
+                raise RateLimited(scope, retry_after)
+        self._counters["allowed"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            **self._counters,
+            "rejected": dict(self._rejected),
+            "rules": {scope: {"capacity": capacity, "per_second": rate} for scope, (capacity, rate) in self.rules.items()},
+            "store": self.store.stats(),
+        }
+
+
+def create_rate_limiter() -> RateLimiter:
+    if os.getenv("OAUTH_RATE_LIMIT_STORE", "memory") == "redis":
+        store = RedisBucketStore(os.getenv("OAUTH_RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0"))
+    else:
+        store = MemoryBucketStore(maxsize=int(os.getenv("OAUTH_RATE_LIMIT_KEYS", "100000")))
+    return RateLimiter(
+        store,
+        rules={
+            "ip": parse_rate(os.getenv("OAUTH_RATE_LIMIT_IP", "60/60")),
+            "username": parse_rate(os.getenv("OAUTH_RATE_LIMIT_USERNAME", "10/60")),
+            # Charged only for failed client authentication on /token; client_id is public
+            "client_id": parse_rate(os.getenv("OAUTH_RATE_LIMIT_CLIENT", "300/60")),
+        },
+        enabled=os.getenv("OAUTH_RATE_LIMIT", "1") == "1"
+    )
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+
+def token_id(key: str) -> str:
+    """Id under which a token key (normally its jti) is stored in revoked_tokens."""
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _prefix(tid: str) -> int:
+    return int(tid[:16], 16)
+
+
+class RevocationList:
+    """
+    In-memory filter of revoked token ids backed by the revoked_tokens table.
+
+    Memory holds only the first 64 bits of each id with the token's expiry, so a
+    lookup for a token that was never revoked is a dict miss and needs no query. A
+    prefix hit is confirmed against the table. Revocations made by other workers
+    are pulled in every `refresh_interval` seconds by reading rows newer than the
+    last load; expired entries fall out of the filter as they are looked up.
+
+    `engine` serves the blocking load at startup; request paths use `async_engine`.
+    """
+
+    def __init__(self, engine: Engine, async_engine: AsyncEngine, refresh_interval: float = 5.0):
+        self.engine = engine
+        self.async_engine = async_engine
+        self.refresh_interval = refresh_interval
+        self._expiry: Dict[int, float] = {}
+        self._loaded_until: Optional[datetime] = None
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+        self._counters = {"checks": 0, "filter_hits": 0, "confirmed": 0, "false_positives": 0, "revoked": 0}
+
+    def _add(self, tid: str, expires_at: Optional[datetime]):
+        # Expiry columns hold naive UTC
+        expiry = expires_at.replace(tzinfo=timezone.utc).timestamp() if expires_at else float("inf")
+        prefix = _prefix(tid)
+        self._expiry[prefix] = max(expiry, self._expiry.get(prefix, 0.0))
+
+    def _load_query(self):
+        query = "SELECT token_hash, expires_at, revoked_at FROM revoked_tokens WHERE expires_at > :now"
+        params: Dict[str, Any] = {"now": datetime.utcnow()}
+        if self._loaded_until is not None:
+            # Overlap the previous load so rows committed late by other workers are not missed
+            query += " AND revoked_at >= :since"
+            params["since"] = self._loaded_until - timedelta(seconds=30)
+        return text(query), params
+
+    def _apply(self, rows, loaded_at: datetime):
+        with self._lock:
+            for tid, expires_at, revoked_at in rows:
+                self._add(tid, _as_datetime(expires_at))
+                revoked_at = _as_datetime(revoked_at)
+                if self._loaded_until is None or revoked_at > self._loaded_until:
+                    self._loaded_until = revoked_at
+            if self._loaded_until is None:
+                self._loaded_until = loaded_at
+
+    def load(self):
+        """Load every unexpired revocation; called once at startup."""
+        query, params = self._load_query()
+        with self.engine.connect() as conn:
+            rows = conn.execute(query, params).all()
+        self._apply(rows, params["now"])
+        self._next_refresh = time.monotonic() + self.refresh_interval
+        logger.info(f"Loaded {len(rows)} revoked tokens")
+
+    async def refresh(self):
+        """Pull revocations recorded since the last load."""
+        # Claim the refresh first so concurrent requests do not all run it
+        self._next_refresh = time.monotonic() + self.refresh_interval
+        query, params = self._load_query()
+        async with self.async_engine.connect() as conn:
+            rows = (await conn.execute(query, params)).all()
+        self._apply(rows, params["now"])
+
+    async def revoke(self, key: str, expires_at: Optional[datetime], conn: AsyncConnection = None):
+        """Record a revocation; pass `conn` to make it part of a caller's transaction."""
+        tid = token_id(key)
+        statement = text(
+            "INSERT INTO revoked_tokens (token_hash, expires_at, revoked_at) VALUES (:tid, :expires_at, :now) "
+            "ON CONFLICT (token_hash) DO NOTHING"
+        )
+        params = {"tid": tid, "expires_at": expires_at, "now": datetime.utcnow()}
+        if conn is None:
+            async with self.async_engine.begin() as own_conn:
+                await own_conn.execute(statement, params)
+        else:
+            await conn.execute(statement, params)
+        with self._lock:
+            self._add(tid, expires_at)
+        self._counters["revoked"] += 1
+
+    async def is_revoked(self, *keys: str) -> bool:
+        """True if any of the keys was revoked."""
+        self._counters["checks"] += 1
+        if time.monotonic() >= self._next_refresh:
+            await self.refresh()
+
+        for key in keys:
+            tid = token_id(key)
+            prefix = _prefix(tid)
+            expiry = self._expiry.get(prefix)
+            if expiry is None:
+                continue
+            if expiry <= time.time():
+                self._expiry.pop(prefix, None)
+                continue
+
+            self._counters["filter_hits"] += 1
+            async with self.async_engine.connect() as conn:
+                found = (await conn.execute(
+                    text("SELECT 1 FROM revoked_tokens WHERE token_hash = :tid"), {"tid": tid}
+                )).first() is not None
+            self._counters["confirmed" if found else "false_positives"] += 1
+            if found:
+                return True
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._expiry.clear()
+            self._loaded_until = None
+            self._next_refresh = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._counters, "size": len(self._expiry)}
+
+
+def _as_datetime(value) -> Optional[datetime]:
+    # SQLite hands back text for raw-SQL DateTime columns
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def create_revocation_list(engine: Engine, async_engine: AsyncEngine) -> RevocationList:
+    return RevocationList(engine, async_engine, refresh_interval=float(os.getenv("OAUTH_REVOCATION_REFRESH", "5")))
@@ -1,72 +1,41 @@
 from fastapi import APIRouter, HTTPException, Depends, Request, Form
-from fastapi.templating import Jinja2Templates
-from fastapi.responses import Response, RedirectResponse
+from fastapi.responses import Response, RedirectResponse, StreamingResponse
 from starlette.middleware.sessions import SessionMiddleware
 from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, String, Integer, DateTime
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from passlib.context import CryptContext
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession as DBSession
 from jose import jwt
 from datetime import datetime, timedelta
 from loguru import logger
+from ttl_cache import TTLCache
+from web_assets import HashedStaticFiles, create_templates
+from oauth.passwords import password_hasher, PasswordPoolBusy
+from oauth.database import Base, engine, async_engine, AsyncSession, get_db
+from oauth.models import UserDB, TokenDB, UserSession
+from oauth.migrations import migrate, drop_schema_version
+from oauth.sweeper import create_sweeper
+from oauth.admin import keyset_page, approximate_count, approximate_counts, page_size, export_ndjson
+from oauth.revocation import create_revocation_list
+from oauth.clients import create_client_registry
+from oauth.rate_limit import create_rate_limiter, RateLimited
+from oauth.auth_codes import create_auth_code_store
+import base64
+import hashlib
+import math
+import secrets
+import os
+import time
 import uuid
 
 router = APIRouter(prefix="/oauth2")
-templates = Jinja2Templates(directory="oauth/templates")
+# Mounted by the app at /oauth2/static; a router cannot carry mounts of its own
+static_files = HashedStaticFiles(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"), "/oauth2/static")
+templates = create_templates(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates"), static_files)
 logger.add("oauth.log")
 
 # Security setup
 SECRET_KEY = "another_secret_key"
 ALGORITHM = "HS256"
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-# Database setup
-Base = declarative_base()
-engine = create_engine("sqlite:///ara.db")
-Session = sessionmaker(bind=engine)
-
-class ClientDB(Base):
-    __tablename__ = "clients"
-    client_id = Column(String, primary_key=True)
-    client_secret = Column(String)
-    redirect_uri = Column(String)
-    name = Column(String)
-
-class UserDB(Base):
-    __tablename__ = "users"
-    id = Column(Integer, primary_key=True)
-    username = Column(String, unique=True)
-    password = Column(String)
-    display_name = Column(String)
-    email = Column(String, unique=True)
-
-class AuthCodeDB(Base):
-    __tablename__ = "auth_codes"
-    code = Column(String, primary_key=True)
-    client_id = Column(String)
-    user_id = Column(Integer)
-    expires_at = Column(DateTime)
-
-class TokenDB(Base):
-    __tablename__ = "tokens"
-    access_token = Column(String, primary_key=True)
-    refresh_token = Column(String)
-    user_id = Column(Integer)
-    client_id = Column(String)
-    expires_at = Column(DateTime)
-
-class UserSession(Base):
-    __tablename__ = "user_sessions"
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer)
-    session_id = Column(String, unique=True)
-    client_id = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    last_active = Column(DateTime, default=datetime.utcnow)
-    is_active = Column(Integer, default=1)
-
-Base.metadata.create_all(engine)
 
 # Utility functions
 def generate_client_id():
@@ -75,27 +44,119 @@ def generate_client_id():
 def generate_client_secret():
     return str(uuid.uuid4())
 
-def create_access_token(user_id: int, client_id: str, expires_delta: timedelta):
-    to_encode = {"sub": str(user_id), "client_id": client_id, "exp": datetime.utcnow() + expires_delta}
+def generate_token_id():
+    return secrets.token_urlsafe(16)
+
+def hash_token(value: str) -> str:
+    """Short fixed-size digest under which refresh tokens are stored and looked up."""
+    return base64.urlsafe_b64encode(hashlib.sha256(value.encode()).digest()[:16]).decode().rstrip("=")
+
+def create_access_token(user_id: int, client_id: str, expires_delta: timedelta, jti: str = None):
+    # The jti is the token's key in the tokens table and in revocations
+    to_encode = {"sub": str(user_id), "client_id": client_id, "exp": datetime.utcnow() + expires_delta,
+                 "jti": jti or generate_token_id()}
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+def access_token_key(token: str, payload: dict) -> str:
+    # Tokens issued before jti claims existed are keyed by a digest, as migration 7 did for their rows
+    return payload.get("jti") or hash_token(token)
+
+# Userinfo fast path: signature-checked token payloads (kept until their exp) and user profiles
+USERINFO_CACHE_ENABLED = os.getenv("OAUTH_USERINFO_CACHE", "1") == "1"
+verified_tokens = TTLCache(maxsize=int(os.getenv("OAUTH_TOKEN_CACHE_SIZE", "100000")))
+user_profiles = TTLCache(maxsize=int(os.getenv("OAUTH_USER_CACHE_SIZE", "50000")),
+                         ttl=float(os.getenv("OAUTH_USER_CACHE_TTL", "300")))
+
+def verify_access_token(token: str) -> dict:
+    """Decode and verify an access token, raising jwt.JWTError if it is invalid."""
+    if USERINFO_CACHE_ENABLED:
+        payload = verified_tokens.get(token)
+        if payload is not None and payload["exp"] > time.time():
+            return payload
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    if USERINFO_CACHE_ENABLED and "exp" in payload:
+        verified_tokens.set(token, payload, ttl=payload["exp"] - time.time())
+    return payload
+
+async def get_user_profile(user_id) -> dict:
+    if USERINFO_CACHE_ENABLED:
+        profile = user_profiles.get(str(user_id))
+        if profile is not None:
+            return profile
+
+    async with AsyncSession() as session:
+        user = await session.get(UserDB, int(user_id))
+    if not user:
+        return None
+
+    profile = {"user_id": user.id, "username": user.username}
+    if USERINFO_CACHE_ENABLED:
+        user_profiles.set(str(user_id), profile)
+    return profile
+
+def invalidate_user(user_id=None):
+    """Drop cached profiles after a user row changes (all of them when user_id is None)."""
+    if user_id is None:
+        user_profiles.clear()
+    else:
+        user_profiles.pop(str(user_id))
+
+# Account picker: active accounts per browser, dropped whenever a login/logout touches that browser
+browser_accounts = TTLCache(maxsize=int(os.getenv("OAUTH_PICKER_CACHE_SIZE", "100000")),
+                            ttl=float(os.getenv("OAUTH_PICKER_CACHE_TTL", "60")))
+
+def get_browser_id(request: Request) -> str:
+    """Stable id for the caller's browser, kept in the signed session cookie."""
+    if "browser_id" not in request.session:
+        request.session["browser_id"] = uuid.uuid4().hex
+    return request.session["browser_id"]
+
+async def get_browser_accounts(session: DBSession, browser_id: str) -> list:
+    accounts = browser_accounts.get(browser_id)
+    if accounts is not None:
+        return accounts
+
+    rows = (await session.execute(select(UserSession, UserDB).join(
+        UserDB, UserSession.user_id == UserDB.id
+    ).filter(UserSession.browser_id == browser_id, UserSession.is_active == 1))).all()
+    # Plain dicts so cached entries never touch a closed session
+    accounts = [
+        (
+            {"session_id": user_session.session_id},
+            {"id": user.id, "username": user.username, "display_name": user.display_name, "email": user.email}
+        )
+        for user_session, user in rows
+    ]
+    browser_accounts.set(browser_id, accounts)
+    return accounts
+
 def recreate_tables():
     try:
         # Drop all tables
         Base.metadata.drop_all(engine)
+        drop_schema_version(engine)
         logger.info("Dropped all existing tables")
         
         # Create all tables
-        Base.metadata.create_all(engine)
+        migrate(engine)
         logger.info("Created all tables with new schema")
+
+        verified_tokens.clear()
+        invalidate_user()
+        browser_accounts.clear()
+        approximate_counts.clear()
+        revocations.clear()
+        auth_codes.clear()
+        clients.load()
     except Exception as e:
         logger.error(f"Error recreating tables: {e}")
 
 # Update ensure_tables to use recreate_tables
 def ensure_tables():
     try:
-        # Create all tables if they don't exist
-        Base.metadata.create_all(engine)
+        # Create missing tables and apply any pending schema migrations
+        migrate(engine)
         logger.info("All database tables created successfully")
     except Exception as e:
         logger.error(f"Error creating database tables: {e}")
@@ -103,40 +164,91 @@ def ensure_tables():
 # Call it when the module is imported
 ensure_tables()
 
+# Started by the app lifespan; deletes expired codes, dead tokens and old inactive sessions
+sweeper = create_sweeper(engine)
+
+# Revoked access tokens, rebuilt from the revoked_tokens table at startup
+revocations = create_revocation_list(engine, async_engine)
+revocations.load()
+
+# Registered clients, loaded once and kept in step with other workers through a version counter
+clients = create_client_registry(engine, async_engine)
+clients.load()
+
+# Authorization codes: in memory by default, redis for several workers, the auth_codes table as a fallback
+auth_codes = create_auth_code_store(async_engine)
+
+async def is_access_token_revoked(token: str, payload: dict) -> bool:
+    # Revocations recorded before migration 7 are keyed by the whole token
+    return await revocations.is_revoked(access_token_key(token, payload), token)
+
+async def authenticate_client(request: Request, client_id: str, client_secret: str) -> str:
+    """Check client credentials from HTTP Basic auth or the form body; return the client_id."""
+    auth_header = request.headers.get("Authorization", "")
+    if auth_header.startswith("Basic "):
+        try:
+            client_id, _, client_secret = base64.b64decode(auth_header[6:]).decode().partition(":")
+        except ValueError:
+            client_id = None
+    if not client_id or not client_secret:
+        raise HTTPException(status_code=401, detail="Client authentication required",
+                            headers={"WWW-Authenticate": "Basic"})
+
+    client = await clients.get(client_id)
+    if not client or not client.verify_secret(client_secret):
+        raise HTTPException(status_code=401, detail="Invalid client credentials",
+                            headers={"WWW-Authenticate": "Basic"})
+    return client_id
+
+def password_pool_busy():
+    return HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+
+# Token buckets per IP, username and client_id on the credential endpoints
+rate_limiter = create_rate_limiter()
+TRUST_FORWARDED_FOR = os.getenv("OAUTH_TRUST_FORWARDED_FOR", "0") == "1"
+
+def client_ip(request: Request) -> str:
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+async def enforce_rate_limit(request: Request, username: str = None, client_id: str = None):
+    """Reject with 429 before any DB or bcrypt work once a caller's bucket is empty."""
+    try:
+        await rate_limiter.check(ip=client_ip(request), username=username.lower() if username else None,
+                                 client_id=client_id)
+    except RateLimited as e:
+        logger.warning(f"Rate limited by {e.scope}: {request.url.path}")
+        raise HTTPException(status_code=429, detail="Too many requests, please retry later",
+                            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+
 # Routes
 @router.post("/register_client")
-def register_client(name: str, redirect_uri: str):
+async def register_client(name: str, redirect_uri: str):
     client_id = generate_client_id()
     client_secret = generate_client_secret()
-    session = Session()
-    client = ClientDB(
-        client_id=client_id,
-        client_secret=client_secret,
-        redirect_uri=redirect_uri,
-        name=name
-    )
-    session.add(client)
-    session.commit()
-    session.close()
+    # The secret is only ever returned here; the registry stores its hash
+    await clients.register(client_id, client_secret, name, redirect_uri)
     return {"client_id": client_id, "client_secret": client_secret}
 
 @router.post("/register_user")
-def register_user(
+async def register_user(
     request: Request,
     username: str = Form(...),
     password: str = Form(...),
     display_name: str = Form(None),
-    email: str = Form(None)
+    email: str = Form(None),
+    session: DBSession = Depends(get_db)
 ):
     try:
         logger.info(f"Registering new user: {username}")
-        hashed_password = pwd_context.hash(password)
-        session = Session()
+        hashed_password = await password_hasher.hash(password)
         
         # Check if username already exists
-        existing_user = session.query(UserDB).filter_by(username=username).first()
+        existing_user = await session.scalar(select(UserDB).filter_by(username=username))
         if existing_user:
-            session.close()
             return {"error": "Username already exists"}
         
         # Create new user with optional fields
@@ -147,36 +259,33 @@ def register_user(
             email=email
         )
         session.add(user)
-        session.commit()
-        session.close()
+        await session.commit()
+        invalidate_user(user.id)
         
         logger.info(f"User registered successfully: {username}")
         return {"message": "User registered successfully"}
+    except PasswordPoolBusy:
+        raise password_pool_busy()
     except Exception as e:
         logger.error(f"Error registering user: {str(e)}", exc_info=True)
         return {"error": str(e)}
 
 @router.get("/test_authorize")
-def authorize_get(request: Request, client_id: str, redirect_uri: str, scope: str, state: str, response_type: str = "code"):
-    session = Session()
-    client = session.query(ClientDB).filter_by(client_id=client_id).first()
-    return {"client": client}
+async def authorize_get(request: Request, client_id: str, redirect_uri: str, scope: str, state: str, response_type: str = "code"):
+    client = await clients.get(client_id)
+    return {"client": {"client_id": client.client_id, "name": client.name, "redirect_uri": client.redirect_uri} if client else None}
 
 @router.get("/authorize")
-def authorize_get(request: Request, client_id: str, redirect_uri: str, scope: str, state: str, response_type: str = "code"):
-    session = Session()
-    client = session.query(ClientDB).filter_by(client_id=client_id).first()
-    session.close()
+async def authorize_get(request: Request, client_id: str, redirect_uri: str, scope: str, state: str, response_type: str = "code",
+                        session: DBSession = Depends(get_db)):
+    client = await clients.get(client_id)
     
     if not client or client.redirect_uri != redirect_uri:
         raise HTTPException(status_code=400, detail="Invalid client or redirect_uri")
     
-    # Get all active sessions
-    db_session = Session()
-    active_sessions = db_session.query(UserSession, UserDB).join(
-        UserDB, UserSession.user_id == UserDB.id
-    ).filter(UserSession.is_active == 1).all()
-    db_session.close()
+    # Only the accounts signed in on this browser
+    browser_id = request.session.get("browser_id")
+    active_sessions = await get_browser_accounts(session, browser_id) if browser_id else []
     
     # If no active sessions, show login page
     if not active_sessions:
@@ -199,11 +308,16 @@ def authorize_get(request: Request, client_id: str, redirect_uri: str, scope: st
     })
 
 @router.get("/select_account")
-def select_account(request: Request, user_id: int, client_id: str, redirect_uri: str, scope: str, state: str):
+async def select_account(request: Request, user_id: int, client_id: str, redirect_uri: str, scope: str, state: str,
+                         session: DBSession = Depends(get_db)):
+    # Only accounts already signed in on this browser can be picked without a password
+    browser_id = request.session.get("browser_id")
+    accounts = await get_browser_accounts(session, browser_id) if browser_id else []
+    if not any(account["id"] == user_id for _, account in accounts):
+        raise HTTPException(status_code=403, detail="Account not signed in on this browser")
+
     # Verify the user exists
-    session = Session()
-    user = session.query(UserDB).filter_by(id=user_id).first()
-    session.close()
+    user = await session.get(UserDB, user_id)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -222,44 +336,41 @@ def select_account(request: Request, user_id: int, client_id: str, redirect_uri:
     })
 
 @router.post("/authorize")
-def authorize_post(request: Request, username: str = Form(...), password: str = Form(...), 
-                  client_id: str = Form(...), redirect_uri: str = Form(...), scope: str = Form(...), state: str = Form(...)):
-    session = Session()
-    user = session.query(UserDB).filter_by(username=username).first()
-    if not user or not pwd_context.verify(password, user.password):
+async def authorize_post(request: Request, username: str = Form(...), password: str = Form(...), 
+                  client_id: str = Form(...), redirect_uri: str = Form(...), scope: str = Form(...), state: str = Form(...),
+                  session: DBSession = Depends(get_db)):
+    await enforce_rate_limit(request, username=username)
+    user = await session.scalar(select(UserDB).filter_by(username=username))
+    try:
+        valid = user is not None and await password_hasher.verify(password, user.password)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
+    if not valid:
         return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid credentials"})
     
     request.session["user_id"] = user.id
-    session.close()
     return templates.TemplateResponse("consent.html", {
         "request": request, "client_id": client_id, "redirect_uri": redirect_uri, "scope": scope, "state": state
     })
 
 @router.post("/consent")
-def consent_post(request: Request, consent: str = Form(...), client_id: str = Form(...), 
-                redirect_uri: str = Form(...), scope: str = Form(...), state: str = Form(...)):
+async def consent_post(request: Request, consent: str = Form(...), client_id: str = Form(...), 
+                       redirect_uri: str = Form(...), scope: str = Form(...), state: str = Form(...),
+                       session: DBSession = Depends(get_db)):
     user_id = request.session.get("user_id")
     if not user_id:
         raise HTTPException(status_code=403, detail="Not logged in")
     
     # Verify the user exists
-    session = Session()
-    user = session.query(UserDB).filter_by(id=user_id).first()
+    user = await session.get(UserDB, user_id)
     if not user:
-        session.close()
         raise HTTPException(status_code=404, detail="User not found")
     
     if consent == "yes":
-        code = str(uuid.uuid4())
-        expires_at = datetime.utcnow() + timedelta(minutes=10)
-        auth_code = AuthCodeDB(code=code, client_id=client_id, user_id=user_id, expires_at=expires_at)
-        session.add(auth_code)
-        session.commit()
-        session.close()
+        code = await auth_codes.issue(client_id, user_id)
         redirect_url = f"{redirect_uri}?code={code}&state={state}"
         return Response(status_code=302, headers={"Location": redirect_url})
     else:
-        session.close()
         redirect_url = f"{redirect_uri}?error=access_denied&state={state}"
         return Response(status_code=302, headers={"Location": redirect_url})
 
@@ -272,53 +383,46 @@ class TokenRequest(BaseModel):
     client_secret: str
 
 @router.post("/token")
-def token(grant_type: str = Form(...), code: str = Form(None), refresh_token: str = Form(None), 
-          redirect_uri: str = Form(...), client_id: str = Form(...), client_secret: str = Form(...)):
+async def token(request: Request, grant_type: str = Form(...), code: str = Form(None), refresh_token: str = Form(None), 
+                redirect_uri: str = Form(...), client_id: str = Form(...), client_secret: str = Form(...),
+                session: DBSession = Depends(get_db)):
     logger.info(f"Token request received - grant_type: {grant_type}, client_id: {client_id}, redirect_uri: {redirect_uri}")
-    session = Session()
     
     # Verify client credentials
-    client = session.query(ClientDB).filter_by(client_id=client_id).first()
-    if not client:
-        logger.info(f"Client not found: {client_id}")
-        session.close()
-        raise HTTPException(status_code=400, detail="Invalid client credentials")
-    if client.client_secret != client_secret:
-        logger.info(f"Invalid client secret for client: {client_id}")
-        session.close()
+    client = await clients.get(client_id)
+    if not client or not client.verify_secret(client_secret):
+        logger.info(f"Client not found or invalid secret: {client_id}")
+        # Only failed authentication draws from the buckets. client_id is public, and a
+        # client's backend redeems grants for all its users from one IP.
+        await enforce_rate_limit(request, client_id=client_id)
         raise HTTPException(status_code=400, detail="Invalid client credentials")
     if client.redirect_uri != redirect_uri:
         logger.info(f"Invalid redirect URI for client: {client_id}. Expected: {client.redirect_uri}, Got: {redirect_uri}")
-        session.close()
         raise HTTPException(status_code=400, detail="Invalid client credentials")
     
     if grant_type == "authorization_code":
         if not code:
             logger.info("No code provided for authorization_code grant type")
-            session.close()
             raise HTTPException(status_code=400, detail="Code is required for authorization_code grant type")
         
-        # Verify authorization code
-        auth_code = session.query(AuthCodeDB).filter_by(code=code).first()
+        # Redeem the authorization code; it is gone afterwards whether or not it matches
+        auth_code = await auth_codes.take(code)
         if not auth_code:
-            logger.info(f"Authorization code not found: {code}")
-            session.close()
+            logger.info(f"Authorization code unknown, used or expired: {code}")
             raise HTTPException(status_code=400, detail="Invalid or expired code")
-        if auth_code.expires_at < datetime.utcnow():
-            logger.info(f"Authorization code expired: {code}")
-            session.close()
+        if auth_code.client_id != client_id:
+            logger.info(f"Authorization code {code} was issued to another client")
             raise HTTPException(status_code=400, detail="Invalid or expired code")
         
         # Generate new tokens
-        access_token = create_access_token(auth_code.user_id, client_id, timedelta(hours=1))
+        jti = generate_token_id()
+        access_token = create_access_token(auth_code.user_id, client_id, timedelta(hours=1), jti=jti)
         refresh_token = str(uuid.uuid4())
-        token_db = TokenDB(access_token=access_token, refresh_token=refresh_token, 
+        token_db = TokenDB(jti=jti, refresh_token_hash=hash_token(refresh_token), 
                           user_id=auth_code.user_id, client_id=client_id, 
                           expires_at=datetime.utcnow() + timedelta(hours=1))
         session.add(token_db)
-        session.delete(auth_code)
-        session.commit()
-        session.close()
+        await session.commit()
         
         logger.info(f"Tokens generated for client: {client_id}, user: {auth_code.user_id}")
         return {
@@ -330,26 +434,28 @@ def token(grant_type: str = Form(...), code: str = Form(None), refresh_token: st
     
     elif grant_type == "refresh_token":
         if not refresh_token:
-            session.close()
             raise HTTPException(status_code=400, detail="Refresh token is required for refresh_token grant type")
         
         # Verify refresh token
-        token_db = session.query(TokenDB).filter_by(refresh_token=refresh_token, client_id=client_id).first()
-        if not token_db:
-            session.close()
+        token_db = await session.scalar(select(TokenDB).filter_by(refresh_token_hash=hash_token(refresh_token)))
+        if not token_db or token_db.client_id != client_id:
             raise HTTPException(status_code=400, detail="Invalid refresh token")
         
         # Generate new tokens
-        new_access_token = create_access_token(token_db.user_id, client_id, timedelta(hours=1))
+        new_jti = generate_token_id()
+        new_access_token = create_access_token(token_db.user_id, client_id, timedelta(hours=1), jti=new_jti)
         new_refresh_token = str(uuid.uuid4())
         
-        # Update token record
-        token_db.access_token = new_access_token
-        token_db.refresh_token = new_refresh_token
-        token_db.expires_at = datetime.utcnow() + timedelta(hours=1)
+        # The replaced access token stops working now rather than at its exp
+        await revocations.revoke(token_db.jti, token_db.expires_at, conn=await session.connection())
+
+        # Replace the row instead of rewriting its primary key in place
+        await session.delete(token_db)
+        session.add(TokenDB(jti=new_jti, refresh_token_hash=hash_token(new_refresh_token),
+                            user_id=token_db.user_id, client_id=client_id,
+                            expires_at=datetime.utcnow() + timedelta(hours=1)))
         
-        session.commit()
-        session.close()
+        await session.commit()
         
         return {
             "access_token": new_access_token,
@@ -359,63 +465,117 @@ def token(grant_type: str = Form(...), code: str = Form(None), refresh_token: st
         }
     
     else:
-        session.close()
         raise HTTPException(status_code=400, detail="Unsupported grant type")
 
 @router.get("/userinfo")
-def userinfo(request: Request):
+async def userinfo(request: Request):
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid authorization header")
     
     token = auth_header.split(" ")[1]
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = verify_access_token(token)
+        if await is_access_token_revoked(token, payload):
+            raise HTTPException(status_code=401, detail="Invalid token")
         user_id = payload.get("sub")
         
-        session = Session()
-        user = session.query(UserDB).filter_by(id=user_id).first()
-        session.close()
-        
-        if not user:
+        profile = await get_user_profile(user_id)
+        if not profile:
             raise HTTPException(status_code=404, detail="User not found")
         
-        return {
-            "user_id": user.id,
-            "username": user.username
-        }
+        return profile
     except jwt.JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+@router.post("/introspect")
+async def introspect(request: Request, token: str = Form(...), token_type_hint: str = Form(None),
+                     client_id: str = Form(None), client_secret: str = Form(None)):
+    """RFC 7662 token introspection for resource servers, authenticated as a registered client."""
+    await authenticate_client(request, client_id, client_secret)
+
+    if token_type_hint != "refresh_token":
+        try:
+            payload = verify_access_token(token)
+        except jwt.JWTError:
+            payload = None
+        if payload is not None:
+            if await is_access_token_revoked(token, payload):
+                return {"active": False}
+            profile = await get_user_profile(payload.get("sub"))
+            if not profile:
+                return {"active": False}
+            return {
+                "active": True,
+                "token_type": "Bearer",
+                "client_id": payload.get("client_id"),
+                "sub": payload.get("sub"),
+                "username": profile["username"],
+                "exp": int(payload["exp"]),
+                "jti": access_token_key(token, payload),
+            }
+
+    async with AsyncSession() as session:
+        token_db = await session.scalar(select(TokenDB).filter_by(refresh_token_hash=hash_token(token)))
+        if not token_db:
+            return {"active": False}
+        return {
+            "active": True,
+            "token_type": "refresh_token",
+            "client_id": token_db.client_id,
+            "sub": str(token_db.user_id),
+        }
+
+@router.post("/revoke")
+async def revoke(request: Request, token: str = Form(...), token_type_hint: str = Form(None),
+                 client_id: str = Form(None), client_secret: str = Form(None), session: DBSession = Depends(get_db)):
+    """RFC 7009 token revocation; a client can only revoke tokens issued to it."""
+    client_id = await authenticate_client(request, client_id, client_secret)
+
+    if token_type_hint != "refresh_token":
+        try:
+            payload = verify_access_token(token)
+        except jwt.JWTError:
+            payload = None
+        if payload is not None:
+            if payload.get("client_id") == client_id:
+                await revocations.revoke(access_token_key(token, payload), datetime.utcfromtimestamp(payload["exp"]))
+                verified_tokens.pop(token)
+            return Response(status_code=200)
+
+    # Revoking a refresh token also ends the access token issued with it
+    token_db = await session.scalar(select(TokenDB).filter_by(refresh_token_hash=hash_token(token), client_id=client_id))
+    if token_db:
+        await revocations.revoke(token_db.jti, token_db.expires_at, conn=await session.connection())
+        await session.delete(token_db)
+        await session.commit()
+    return Response(status_code=200)
+
 @router.get("/dashboard")
-def dashboard(request: Request):
+async def dashboard(request: Request, sessions_after: str = None, clients_after: str = None, users_after: str = None,
+                    limit: int = None, session: DBSession = Depends(get_db)):
     try:
-        session = Session()
-        # Get all active sessions
-        active_sessions = session.query(UserSession, UserDB).join(
-            UserDB, UserSession.user_id == UserDB.id
-        ).filter(UserSession.is_active == 1).all()
-        
-        # Get all clients
-        clients = session.query(ClientDB).all()
-        
-        # Get all users
-        users = session.query(UserDB).all()
-        
-        session.close()
-        
+        # Each section is its own keyset-paginated list
+        sections = {}
+        for view, after in (("active_sessions", sessions_after), ("clients", clients_after), ("users", users_after)):
+            rows, next_cursor = await keyset_page(session, view, after, limit)
+            sections[view] = {"rows": rows, "next": next_cursor, "count": await approximate_count(session, view)}
+
         return templates.TemplateResponse("dashboard.html", {
             "request": request,
-            "active_sessions": active_sessions,
-            "clients": clients,
-            "users": users
+            "active_sessions": sections["active_sessions"],
+            "clients": sections["clients"],
+            "users": sections["users"],
+            "limit": page_size(limit)
         })
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"Error in dashboard: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/login")
-def login_get(request: Request, client_id: str = None, redirect_uri: str = None, scope: str = None, state: str = None):
+async def login_get(request: Request, client_id: str = None, redirect_uri: str = None, scope: str = None, state: str = None):
     return templates.TemplateResponse("login.html", {
         "request": request,
         "error": None,
@@ -426,18 +586,17 @@ def login_get(request: Request, client_id: str = None, redirect_uri: str = None,
     })
 
 @router.post("/login")
-def login_post(request: Request, username: str = Form(...), password: str = Form(...),
+async def login_post(request: Request, username: str = Form(...), password: str = Form(...),
               client_id: str = Form(None), redirect_uri: str = Form(None), 
-              scope: str = Form(None), state: str = Form(None)):
+              scope: str = Form(None), state: str = Form(None), session: DBSession = Depends(get_db)):
+    await enforce_rate_limit(request, username=username)
     try:
         logger.info(f"Login attempt for username: {username}")
-        session = Session()
         
         # Find user
-        user = session.query(UserDB).filter_by(username=username).first()
+        user = await session.scalar(select(UserDB).filter_by(username=username))
         if not user:
             logger.warning(f"User not found: {username}")
-            session.close()
             return templates.TemplateResponse("login.html", {
                 "request": request,
                 "error": "Invalid credentials",
@@ -448,9 +607,8 @@ def login_post(request: Request, username: str = Form(...), password: str = Form
             })
         
         # Verify password
-        if not pwd_context.verify(password, user.password):
+        if not await password_hasher.verify(password, user.password):
             logger.warning(f"Invalid password for user: {username}")
-            session.close()
             return templates.TemplateResponse("login.html", {
                 "request": request,
                 "error": "Invalid credentials",
@@ -466,20 +624,22 @@ def login_post(request: Request, username: str = Form(...), password: str = Form
         session_id = str(uuid.uuid4())
         logger.info(f"Creating new session: {session_id} for user: {username}")
         
+        browser_id = get_browser_id(request)
         user_session = UserSession(
             user_id=user.id,
             session_id=session_id,
-            client_id=client_id  # Store the client_id if this is an OAuth2 flow
+            client_id=client_id,  # Store the client_id if this is an OAuth2 flow
+            browser_id=browser_id
         )
         session.add(user_session)
-        session.commit()
+        await session.commit()
+        browser_accounts.pop(browser_id)
         
         # Store session ID in request session
         request.session["session_id"] = session_id
         request.session["user_id"] = user.id
         logger.info(f"Session stored for user: {username}")
         
-        session.close()
 
         # If this is part of an OAuth2 flow, show the consent page
         if client_id and redirect_uri:
@@ -494,6 +654,8 @@ def login_post(request: Request, username: str = Form(...), password: str = Form
         
         # Otherwise, go to dashboard
         return RedirectResponse(url="/oauth2/dashboard", status_code=303)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
     except Exception as e:
         logger.error(f"Error in login: {str(e)}", exc_info=True)
         return templates.TemplateResponse("login.html", {
@@ -506,32 +668,35 @@ def login_post(request: Request, username: str = Form(...), password: str = Form
         })
 
 @router.post("/logout")
-def logout(request: Request, session_id: str = Form(None)):
+async def logout(request: Request, session_id: str = Form(None), db_session: DBSession = Depends(get_db)):
     try:
-        db_session = Session()
         
         # If specific session_id is provided, log out that session
         if session_id:
-            user_session = db_session.query(UserSession).filter_by(session_id=session_id).first()
+            user_session = await db_session.scalar(select(UserSession).filter_by(session_id=session_id))
             if user_session:
                 user_session.is_active = 0
-                db_session.commit()
+                await db_session.commit()
+                browser_accounts.pop(user_session.browser_id)
                 logger.info(f"Logged out session: {session_id}")
         else:
             # Otherwise, log out the current session
             current_session_id = request.session.get("session_id")
             if current_session_id:
-                user_session = db_session.query(UserSession).filter_by(session_id=current_session_id).first()
+                user_session = await db_session.scalar(select(UserSession).filter_by(session_id=current_session_id))
                 if user_session:
                     user_session.is_active = 0
-                    db_session.commit()
+                    await db_session.commit()
+                    browser_accounts.pop(user_session.browser_id)
                     logger.info(f"Logged out current session: {current_session_id}")
         
-        db_session.close()
-        
         # Clear the session if it's the current session being logged out
         if not session_id:
+            # Keep the browser id so other accounts on this browser stay in the picker
+            browser_id = request.session.get("browser_id")
             request.session.clear()
+            if browser_id:
+                request.session["browser_id"] = browser_id
             return RedirectResponse(url="/oauth2/login", status_code=303)
         
         # If logging out another session, stay on dashboard
@@ -541,57 +706,77 @@ def logout(request: Request, session_id: str = Form(None)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/switch_account")
-def switch_account(request: Request, user_id: int = Form(...)):
+async def switch_account(request: Request, user_id: int = Form(...), db_session: DBSession = Depends(get_db)):
     session_id = request.session.get("session_id")
     if not session_id:
         raise HTTPException(status_code=401, detail="Not logged in")
     
-    db_session = Session()
     # Deactivate current session
-    current_session = db_session.query(UserSession).filter_by(session_id=session_id).first()
+    current_session = await db_session.scalar(select(UserSession).filter_by(session_id=session_id))
     if current_session:
         current_session.is_active = 0
     
     # Create new session for selected user
     new_session_id = str(uuid.uuid4())
+    browser_id = get_browser_id(request)
     new_session = UserSession(
         user_id=user_id,
         session_id=new_session_id,
-        client_id=current_session.client_id if current_session else None
+        client_id=current_session.client_id if current_session else None,
+        browser_id=browser_id
     )
     db_session.add(new_session)
-    db_session.commit()
+    await db_session.commit()
+    browser_accounts.pop(browser_id)
     
     # Update request session
     request.session["session_id"] = new_session_id
     request.session["user_id"] = user_id
     
-    db_session.close()
     return RedirectResponse(url="/oauth2/dashboard", status_code=303)
 
 @router.get("/")
-def oauth_root(request: Request):
+async def oauth_root(request: Request):
     session_id = request.session.get("session_id")
     if session_id:
         return RedirectResponse(url="/oauth2/dashboard", status_code=303)
     return RedirectResponse(url="/oauth2/login", status_code=303)
 
+@router.get("/stats")
+async def oauth_stats():
+    return {
+        "userinfo": {
+            "enabled": USERINFO_CACHE_ENABLED,
+            "tokens": verified_tokens.stats(),
+            "profiles": user_profiles.stats()
+        },
+        "passwords": password_hasher.stats(),
+        "account_picker": browser_accounts.stats(),
+        "revocations": revocations.stats(),
+        "clients": clients.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "auth_codes": auth_codes.stats(),
+        "sweeper": sweeper.stats()
+    }
+
 @router.get("/debug/db")
-def debug_db():
+async def debug_db(request: Request, format: str = None, users_after: str = None, clients_after: str = None,
+                   sessions_after: str = None, limit: int = None, session: DBSession = Depends(get_db)):
+    # ?format=ndjson (or Accept: application/x-ndjson) streams every row instead of one page
+    if format == "ndjson" or "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(export_ndjson(["users", "clients", "sessions"]), media_type="application/x-ndjson")
+
     try:
-        session = Session()
-        users = session.query(UserDB).all()
-        clients = session.query(ClientDB).all()
-        user_sessions = session.query(UserSession).all()
-        
-        result = {
-            "users": [{"id": u.id, "username": u.username} for u in users],
-            "clients": [{"client_id": c.client_id, "redirect_uri": c.redirect_uri} for c in clients],
-            "sessions": [{"session_id": s.session_id, "user_id": s.user_id, "is_active": s.is_active} for s in user_sessions]
-        }
+        result = {"counts": {}, "next": {}}
+        for view, after in (("users", users_after), ("clients", clients_after), ("sessions", sessions_after)):
+            rows, next_cursor = await keyset_page(session, view, after, limit)
+            result[view] = rows
+            result["next"][f"{view}_after"] = next_cursor
+            result["counts"][view] = await approximate_count(session, view)
         
-        session.close()
         return result
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"Debug error: {str(e)}", exc_info=True)
         return {"error": str(e)}
@@ -599,6 +784,7 @@ def debug_db():
 @router.post("/debug/recreate_tables")
 def debug_recreate_tables():
     """Debug endpoint to recreate all database tables"""
+    # Left sync on purpose: a rare maintenance call that runs DDL through the sync engine
     try:
         recreate_tables()
         return {"message": "Tables recreated successfully"}
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+
+class ExpirySweeper:
+    """
+    Periodically deletes expired auth codes, dead tokens, logged-out sessions and
+    revocations of tokens that have since expired.
+
+    Rows are deleted in batches of `batch_size` with a pause between batches, so the
+    write lock is only ever held for one small batch. Each run is capped at
+    `max_rows_per_run` rows; a backlog is worked off over several runs. SQLite files
+    get an incremental vacuum after every run. A full VACUUM rewrites the file under
+    an exclusive lock, so it runs once to switch auto_vacuum to INCREMENTAL and
+    after that only every `vacuum_interval` seconds if that is set (0 = never).
+
+    Args:
+        engine: Engine for the OAuth database
+        interval: Seconds between runs
+        refresh_token_ttl: A token row is dead once its access token expired this long ago
+        session_grace: Inactive sessions are kept this long after their last activity
+    """
+
+    def __init__(self, engine: Engine, interval: float = 300, batch_size: int = 500,
+                 batch_pause: float = 0.05, max_rows_per_run: int = 50000,
+                 refresh_token_ttl: timedelta = timedelta(days=30),
+                 session_grace: timedelta = timedelta(days=1),
+                 vacuum_interval: float = 0, incremental_vacuum_pages: int = 2000):
+        self.engine = engine
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.max_rows_per_run = max_rows_per_run
+        self.refresh_token_ttl = refresh_token_ttl
+        self.session_grace = session_grace
+        self.vacuum_interval = vacuum_interval
+        self.incremental_vacuum_pages = incremental_vacuum_pages
+        self._task: Optional[asyncio.Task] = None
+        self._last_vacuum = time.monotonic()
+        self._stats: Dict[str, Any] = {"runs": 0, "reclaimed": {}, "last_run": None, "vacuums": 0, "errors": 0}
+
+    def _sweeps(self):
+        now = datetime.utcnow()
+        # (table, key column, condition, params)
+        return [
+            ("auth_codes", "code", "expires_at < :cutoff", {"cutoff": now}),
+            ("tokens", "jti", "expires_at < :cutoff", {"cutoff": now - self.refresh_token_ttl}),
+            ("user_sessions", "id", "is_active = 0 AND last_active < :cutoff", {"cutoff": now - self.session_grace}),
+            # A revoked token needs no entry once it would have expired anyway
+            ("revoked_tokens", "token_hash", "expires_at < :cutoff", {"cutoff": now}),
+        ]
+
+    def _delete_batches(self, table: str, key: str, condition: str, params: Dict[str, Any], budget: int) -> int:
+        statement = text(
+            f"DELETE FROM {table} WHERE {key} IN "
+            f"(SELECT {key} FROM {table} WHERE {condition} LIMIT :batch_size)"
+        )
+        deleted = 0
+        while deleted < budget:
+            with self.engine.begin() as conn:
+                count = conn.execute(statement, {**params, "batch_size": min(self.batch_size, budget - deleted)}).rowcount
+            deleted += count
+            if count < self.batch_size:
+                break
+            time.sleep(self.batch_pause)
+        return deleted
+
+    def sweep_once(self) -> Dict[str, int]:
+        """Run one sweep synchronously and return rows deleted per table."""
+        started = time.monotonic()
+        budget = self.max_rows_per_run
+        reclaimed = {}
+        for table, key, condition, params in self._sweeps():
+            reclaimed[table] = self._delete_batches(table, key, condition, params, budget)
+            budget -= reclaimed[table]
+
+        self._vacuum()
+
+        self._stats["runs"] += 1
+        for table, count in reclaimed.items():
+            self._stats["reclaimed"][table] = self._stats["reclaimed"].get(table, 0) + count
+        self._stats["last_run"] = {
+            "at": datetime.utcnow().isoformat(),
+            "seconds": time.monotonic() - started,
+            "reclaimed": reclaimed,
+        }
+        logger.info(f"Expiry sweep reclaimed {reclaimed}")
+        return reclaimed
+
+    def _vacuum(self):
+        full = self.vacuum_interval > 0 and time.monotonic() - self._last_vacuum >= self.vacuum_interval
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            if self.engine.dialect.name == "sqlite":
+                # 2 = INCREMENTAL; the mode only changes on the next VACUUM, so one is needed once
+                full = full or conn.execute(text("PRAGMA auto_vacuum")).scalar() != 2
+                if full:
+                    conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+                    conn.execute(text("VACUUM"))
+                else:
+                    conn.execute(text(f"PRAGMA incremental_vacuum({int(self.incremental_vacuum_pages)})"))
+            elif full:
+                for table, _, _, _ in self._sweeps():
+                    conn.execute(text(f"VACUUM ANALYZE {table}"))
+        if full:
+            self._last_vacuum = time.monotonic()
+            self._stats["vacuums"] += 1
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep_once)
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"Expiry sweep failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "running": self._task is not None}
+
+
+def create_sweeper(engine: Engine) -> ExpirySweeper:
+    return ExpirySweeper(
+        engine,
+        interval=float(os.getenv("OAUTH_SWEEP_INTERVAL", "300")),
+        batch_size=int(os.getenv("OAUTH_SWEEP_BATCH_SIZE", "500")),
+        batch_pause=float(os.getenv("OAUTH_SWEEP_BATCH_PAUSE", "0.05")),
+        max_rows_per_run=int(os.getenv("OAUTH_SWEEP_MAX_ROWS", "50000")),
+        refresh_token_ttl=timedelta(days=float(os.getenv("OAUTH_REFRESH_TOKEN_TTL_DAYS", "30"))),
+        session_grace=timedelta(hours=float(os.getenv("OAUTH_SESSION_GRACE_HOURS", "24"))),
+        vacuum_interval=float(os.getenv("OAUTH_VACUUM_INTERVAL", "0"))
+    )
@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from loguru import logger
+
+from ttl_cache import TTLCache
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", prompt.casefold()).strip(" ?!.")
+
+
+def ngrams(text: str, n: int = 3) -> Set[str]:
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class ResponseCache:
+    """
+    Cache of model answers keyed on (model, system prompt, normalized prompt).
+
+    Exact hits come from an in-memory LRU with a TTL, backed by an optional SQLite
+    file so answers survive restarts. When near_duplicate_threshold is set, a miss
+    falls back to the cached prompt with the highest character-trigram Jaccard
+    similarity above the threshold.
+
+    SQLite reads and writes run in a worker thread so a miss never blocks the
+    event loop; expired rows are pruned at most every `prune_interval` seconds.
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 86400, path: Optional[str] = None,
+                 near_duplicate_threshold: float = 0.0, prune_interval: float = 600):
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self.path = path
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        # scope -> {key: trigrams}, only populated when the near-duplicate tier is on
+        self._shingles: Dict[str, Dict[str, Set[str]]] = {}
+        self._lock = threading.Lock()
+        # Held by worker threads around the shared connection, never by the event loop
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._next_prune = 0.0
+        self._stats = {"hits": 0, "near_hits": 0, "persistent_hits": 0, "misses": 0}
+        if path:
+            self._open(path)
+
+    def _open(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # With WAL this only risks the last commits on power loss, never corruption
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                scope TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_created_at ON response_cache (created_at)")
+        self._db.commit()
+
+        # Warm memory with the newest entries that are still fresh
+        rows = self._db.execute(
+            "SELECT key, scope, prompt, response, created_at FROM response_cache "
+            "WHERE created_at > ? ORDER BY created_at DESC LIMIT ?",
+            (time.time() - self.ttl, self._memory.maxsize)
+        ).fetchall()
+        for key, scope, prompt, response, created_at in reversed(rows):
+            self._remember(key, scope, prompt, response, self.ttl - (time.time() - created_at))
+        logger.info(f"Response cache loaded {len(rows)} entries from {path}")
+
+    @staticmethod
+    def _scope(model: str, system_prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{system_prompt}".encode()).hexdigest()
+
+    @staticmethod
+    def _key(scope: str, prompt: str) -> str:
+        return hashlib.sha256(f"{scope}\0{prompt}".encode()).hexdigest()
+
+    def _remember(self, key: str, scope: str, prompt: str, response: str, ttl: float):
+        self._memory.set(key, (scope, response), ttl=ttl)
+        if self.near_duplicate_threshold:
+            self._shingles.setdefault(scope, {})[key] = ngrams(prompt)
+
+    def _nearest(self, scope: str, prompt: str) -> Optional[str]:
+        candidates = self._shingles.get(scope)
+        if not candidates:
+            return None
+
+        grams = ngrams(prompt)
+        best_key, best_score = None, self.near_duplicate_threshold
+        for key, other in list(candidates.items()):
+            if key not in self._memory:
+                # Evicted or expired from the LRU
+                del candidates[key]
+                continue
+            score = jaccard(grams, other)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def _load(self, key: str):
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT response, created_at FROM response_cache WHERE key = ? AND created_at > ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+
+    def _store(self, key: str, scope: str, prompt: str, response: str):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, scope, prompt, response, created_at) VALUES (?, ?, ?, ?, ?)",
+                (key, scope, prompt, response, time.time())
+            )
+            if time.monotonic() >= self._next_prune:
+                self._next_prune = time.monotonic() + self.prune_interval
+                self._db.execute("DELETE FROM response_cache WHERE created_at <= ?", (time.time() - self.ttl,))
+            self._db.commit()
+
+    async def get(self, model: str, system_prompt: str, prompt: str) -> Optional[str]:
+        scope = self._scope(model, system_prompt)
+        normalized = normalize_prompt(prompt)
+        key = self._key(scope, normalized)
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._stats["hits"] += 1
+                return entry[1]
+
+        if self._db is not None:
+            row = await asyncio.to_thread(self._load, key)
+            if row:
+                with self._lock:
+                    self._remember(key, scope, normalized, row[0], self.ttl - (time.time() - row[1]))
+                    self._stats["persistent_hits"] += 1
+                return row[0]
+
+        with self._lock:
+            if self.near_duplicate_threshold:
+                near_key = self._nearest(scope, normalized)
+                if near_key is not None:
+                    self._stats["near_hits"] += 1
+                    return self._memory.get(near_key)[1]
+
+            self._stats["misses"] += 1
+            return None
+
+    async def set(self, model: str, system_prompt: str, prompt: str, response: str):
+        scope = self._scope(model, system_prompt)
+        normalized = normalize_prompt(prompt)
+        key = self._key(scope, normalized)
+
+        with self._lock:
+            self._remember(key, scope, normalized, response, self.ttl)
+        if self._db is not None:
+            await asyncio.to_thread(self._store, key, scope, normalized, response)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = sum(self._stats.values())
+        hits = lookups - self._stats["misses"]
+        return {
+            **self._stats,
+            "size": len(self._memory),
+            "maxsize": self._memory.maxsize,
+            "evictions": self._memory.evictions,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "persistent": self._db is not None,
+        }
+
+
+response_cache = ResponseCache(
+    maxsize=int(os.getenv("AI_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("AI_CACHE_TTL", "86400")),
+    path=os.getenv("AI_CACHE_PATH") or None,
+    near_duplicate_threshold=float(os.getenv("AI_CACHE_NEAR_DUP_THRESHOLD", "0")),
+    prune_interval=float(os.getenv("AI_CACHE_PRUNE_INTERVAL", "600"))
+)
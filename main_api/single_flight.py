@@ -0,0 +1,57 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from ttl_cache import TTLCache
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one execution.
+
+    Every caller with the same key awaits the first caller's task. Successful
+    results are kept in a bounded TTL map, so a retry shortly after completion
+    gets the stored result without running the work again.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.coalesced = 0
+        self.executed = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        return self.results.get(key)
+
+    def remember(self, key: Hashable, result: Any):
+        self.results.set(key, result)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        result = self.results.get(key)
+        if result is not None:
+            return result
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.executed += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+
+        # Shielded so one impatient caller disconnecting doesn't cancel the others
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.results.set(key, task.result())
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._in_flight),
+            "stored": len(self.results),
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "stored_hits": self.results.hits,
+        }
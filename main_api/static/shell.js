@@ -0,0 +1,43 @@
+const output = document.getElementById('output');
+const commandInput = document.getElementById('command-input');
+const prompt = document.getElementById('prompt');
+
+function addOutput(text, isError = false) {
+    const line = document.createElement('div');
+    line.className = 'output-line' + (isError ? ' error' : '');
+    line.textContent = text;
+    output.appendChild(line);
+    output.scrollTop = output.scrollHeight;
+}
+
+async function executeCommand(command) {
+    try {
+        const response = await fetch('/execute', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ command }),
+        });
+        const data = await response.json();
+
+        if (data.error) {
+            addOutput(data.error, true);
+        } else {
+            addOutput(data.output);
+        }
+    } catch (error) {
+        addOutput('Error executing command: ' + error.message, true);
+    }
+}
+
+commandInput.addEventListener('keypress', async (e) => {
+    if (e.key === 'Enter') {
+        const command = commandInput.value.trim();
+        if (command) {
+            addOutput(`$ ${command}`);
+            await executeCommand(command);
+            commandInput.value = '';
+        }
+    }
+});
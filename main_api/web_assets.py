@@ -0,0 +1,229 @@
+import gzip
+import hashlib
+import os
+import re
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
+from loguru import logger
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional; without it every client that asks for compression gets gzip
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+_HASHED_NAME = re.compile(r"^(?P<stem>.+)\.(?P<digest>[0-9a-f]{12})(?P<ext>\.[^./]+)$")
+
+
+class HashedStaticFiles(StaticFiles):
+    """
+    Static files addressed by content hash, e.g. /static/shell.3f2a9c1e0b7d.css.
+
+    `url(name)` puts the first 12 hex digits of the file's sha256 into its name, so a
+    response for the current hash never changes and is cached for a year. A stale
+    hash (a page rendered before a deploy) still gets the current file, but with
+    no-cache. Digests are remembered per mtime, so edited files get new URLs
+    without a restart.
+    """
+
+    def __init__(self, directory: str, mount_path: str):
+        super().__init__(directory=directory)
+        self.mount_path = mount_path.rstrip("/")
+        self._digests: Dict[str, Tuple[int, str]] = {}
+
+    def digest(self, name: str) -> str:
+        path = os.path.join(self.directory, name)
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._digests.get(name)
+        if cached is None or cached[0] != mtime:
+            with open(path, "rb") as f:
+                cached = (mtime, hashlib.sha256(f.read()).hexdigest()[:12])
+            self._digests[name] = cached
+        return cached[1]
+
+    def url(self, name: str) -> str:
+        stem, ext = os.path.splitext(name)
+        return f"{self.mount_path}/{stem}.{self.digest(name)}{ext}"
+
+    async def get_response(self, path: str, scope):
+        match = _HASHED_NAME.match(path)
+        name = match["stem"] + match["ext"] if match else path
+        response = await super().get_response(name, scope)
+        if response.status_code in (200, 304):
+            fresh = match is not None and match["digest"] == self.digest(name)
+            response.headers["Cache-Control"] = IMMUTABLE if fresh else "no-cache"
+        return response
+
+
+def create_templates(directory: str, assets: HashedStaticFiles) -> Jinja2Templates:
+    """
+    Jinja2Templates with a bytecode cache on disk and a `static_url()` global.
+
+    Compiled templates outlive the process, so a new worker (or a --reload) loads
+    them instead of parsing every template again. Jinja checks each entry against
+    the template source, so an edited template is simply recompiled.
+    TEMPLATE_CACHE_DIR picks the directory; by default Jinja uses a private one
+    under the system temp directory.
+    """
+    templates = Jinja2Templates(directory=directory)
+    try:
+        templates.env.bytecode_cache = FileSystemBytecodeCache(os.getenv("TEMPLATE_CACHE_DIR") or None)
+    except OSError as e:
+        logger.warning(f"Template bytecode cache disabled: {e}")
+    templates.env.globals["static_url"] = assets.url
+    return templates
+
+
+_COMPRESSIBLE = ("text/", "application/json", "application/javascript", "application/x-ndjson", "image/svg+xml")
+
+
+class ResponseCompressor:
+    """
+    Picks an encoding for a request and compresses whole response bodies.
+
+    Only responses that declare a Content-Length of at least `minimum_size` and a
+    text-like content type are compressed, so streams (SSE, NDJSON exports) pass
+    through untouched and are never buffered. Brotli is preferred when the client
+    accepts it and the brotli package is installed, gzip otherwise.
+    """
+
+    def __init__(self, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5,
+                 enabled: bool = True):
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.enabled = enabled
+        self._counters = {"compressed": 0, "skipped": 0, "bytes_in": 0, "bytes_out": 0}
+        self._encodings = {"br": 0, "gzip": 0}
+
+    def negotiate(self, accept_encoding: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        accepted = set()
+        for item in accept_encoding.split(","):
+            coding, _, params = item.partition(";")
+            params = params.replace(" ", "")
+            try:
+                weight = float(params[2:]) if params.startswith("q=") else 1.0
+            except ValueError:
+                weight = 1.0
+            if weight > 0:
+                accepted.add(coding.strip().lower())
+        if brotli is not None and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    def should_compress(self, headers: Headers) -> bool:
+        content_type = headers.get("content-type", "")
+        eligible = (
+            "content-encoding" not in headers
+            and int(headers.get("content-length", 0)) >= self.minimum_size
+            and content_type.startswith(_COMPRESSIBLE)
+            and not content_type.startswith("text/event-stream")
+        )
+        if not eligible:
+            self._counters["skipped"] += 1
+        return eligible
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+        self._counters["compressed"] += 1
+        self._counters["bytes_in"] += len(body)
+        self._counters["bytes_out"] += len(compressed)
+        self._encodings[encoding] += 1
+        return compressed
+
+    def stats(self) -> Dict[str, Any]:
+        bytes_in = self._counters["bytes_in"]
+        return {
+            "enabled": self.enabled,
+            "brotli_available": brotli is not None,
+            "minimum_size": self.minimum_size,
+            **self._counters,
+            "encodings": dict(self._encodings),
+            "ratio": self._counters["bytes_out"] / bytes_in if bytes_in else None,
+        }
+
+
+def weaken_etag(headers: MutableHeaders):
+    # A strong ETag promises identical bytes, which the encoded body no longer is
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        headers["ETag"] = "W/" + etag
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware that applies a ResponseCompressor to every HTTP response.
+
+    Compressed responses carry their ETag as a weak validator, as do 304s to clients
+    that negotiated an encoding, so If-None-Match handlers must compare weakly.
+    """
+
+    def __init__(self, app, compressor: ResponseCompressor):
+        self.app = app
+        self.compressor = compressor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = self.compressor.negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        chunks = []
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                if self.compressor.should_compress(Headers(raw=message["headers"])):
+                    # Hold the headers until the body is known
+                    start = message
+                else:
+                    if message["status"] == 304:
+                        # Revalidates the encoded body the client holds
+                        weaken_etag(MutableHeaders(raw=message["headers"]))
+                    await send(message)
+                return
+            if start is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = self.compressor.compress(b"".join(chunks), encoding)
+            headers = MutableHeaders(raw=start["headers"])
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            weaken_etag(headers)
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def create_compressor() -> ResponseCompressor:
+    return ResponseCompressor(
+        minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")),
+        gzip_level=int(os.getenv("COMPRESSION_GZIP_LEVEL", "6")),
+        brotli_quality=int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5")),
+        enabled=os.getenv("COMPRESSION", "1") == "1"
+    )
+
+
+compressor = create_compressor()